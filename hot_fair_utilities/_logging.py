@@ -14,5 +14,5 @@ def get_logger(name: str) -> logging.Logger:
     return logger
 
 
-def track(sequence, description: str = "Processing..."):
-    return rich_track(sequence, description=description)
+def track(sequence, description: str = "Processing...", total: float | None = None):
+    return rich_track(sequence, description=description, total=total)
@@ -0,0 +1,131 @@
+import json
+import os
+from functools import cache
+from pathlib import Path
+
+import rasterio
+from pyproj import Transformer
+
+from .._logging import get_logger, track
+from ..tile_catalog import tile_id_from_filename
+from ..utils import atomic_write
+
+log = get_logger(__name__)
+
+CHIP_INDEX_FILENAME = "chip_index.json"
+
+
+def chip_index_path(output_path: str) -> str:
+    """Return the path of the chip index of a preprocessed directory."""
+    return os.path.join(output_path, CHIP_INDEX_FILENAME)
+
+
+@cache
+def _transformer(source_crs: str, target_crs: str) -> Transformer:
+    return Transformer.from_crs(source_crs, target_crs, always_xy=True)
+
+
+def _transform_bounds(bounds, source_crs: str, target_crs: str) -> list[float]:
+    """Transform the corners of (left, bottom, right, top) bounds from one CRS to another."""
+    if source_crs == target_crs:
+        return list(bounds)
+    transformer = _transformer(source_crs, target_crs)
+    left, bottom = transformer.transform(bounds[0], bounds[1])
+    right, top = transformer.transform(bounds[2], bounds[3])
+    return [left, bottom, right, top]
+
+
+def read_chip_metadata(chip_path: str) -> dict:
+    """Open a chip once and return its metadata.
+
+    Returns:
+        A dict with the "width", "height", "count", "dtype", "crs",
+        "transform" (the six affine coefficients), "res", the bounds in
+        EPSG:3857 and EPSG:4326 as (left, bottom, right, top), and the
+        "size" and "mtime_ns" of the file.
+    """
+    stat = os.stat(chip_path)
+    with rasterio.open(chip_path) as src:
+        if src.crs is None:
+            raise ValueError(f"No CRS found in {chip_path}")
+        crs = src.crs.to_string()
+        return {
+            "width": src.width,
+            "height": src.height,
+            "count": src.count,
+            "dtype": src.dtypes[0],
+            "crs": crs,
+            "transform": list(src.transform)[:6],
+            "res": list(src.res),
+            "bounds_3857": _transform_bounds(src.bounds, crs, "EPSG:3857"),
+            "bounds_4326": _transform_bounds(src.bounds, crs, "EPSG:4326"),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+
+
+def _is_current(entry: dict | None, chip_path: str) -> bool:
+    """Whether an index entry still describes the chip file, judged by its size and mtime."""
+    if entry is None:
+        return False
+    try:
+        stat = os.stat(chip_path)
+    except FileNotFoundError:
+        return False
+    return entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns
+
+
+def load_chip_index(path: str) -> dict[str, dict]:
+    """Load a chip index, or an empty one if it does not exist.
+
+    Returns:
+        Chip metadata by tile id, as returned by read_chip_metadata.
+    """
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def update_chip_index(path: str, chip_paths: list[str]) -> None:
+    """Add the metadata of some chips to a chip index, creating it if needed.
+
+    Each chip is opened once. Entries of chips that no longer exist are
+    dropped.
+
+    Args:
+        path: Path of the chip index.
+        chip_paths: Chips to (re)index. The chips directory is expected to
+            be "chips" next to the index.
+    """
+    chips_dir = Path(path).parent / "chips"
+    index = {
+        tile_id: entry for tile_id, entry in load_chip_index(path).items() if (chips_dir / f"{tile_id}.tif").is_file()
+    }
+    for chip_path in track(chip_paths, description="Indexing chips"):
+        index[tile_id_from_filename(chip_path)] = read_chip_metadata(chip_path)
+
+    with atomic_write(path) as temp_path, open(temp_path, "w") as file:
+        json.dump(index, file, indent=1, sort_keys=True)
+    log.info("Indexed %d chips in %s", len(index), path)
+
+
+def chip_metadata(chip_paths: list[str], index_path: str | None = None) -> list[dict]:
+    """Return the metadata of chips, from a chip index where it is current.
+
+    Chips missing from the index, or modified since they were indexed, are
+    opened instead.
+
+    Args:
+        chip_paths: Paths of the chips.
+        index_path: Path of the chip index written by preprocess, if any.
+
+    Returns:
+        The metadata of each chip, as returned by read_chip_metadata.
+    """
+    index = load_chip_index(index_path) if index_path else {}
+    metadata = []
+    for chip_path in chip_paths:
+        entry = index.get(tile_id_from_filename(chip_path))
+        metadata.append(entry if _is_current(entry, chip_path) else read_chip_metadata(chip_path))
+    return metadata
@@ -1,32 +1,195 @@
+import math
 import os
-import re
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from glob import glob
 from pathlib import Path
 
 import geopandas
-import mercantile
 import numpy as np
 import rasterio
 from rasterio.features import rasterize as rasterize_shapes
 from rasterio.transform import from_bounds
 from shapely.geometry import box
 
-from .._logging import track
+from .._logging import get_logger, track
+from ..tile_catalog import TileCatalog
+from .label_store import LABEL_FORMATS, label_store_path, write_label_store
+from .read_labels import read_labels
 
+log = get_logger(__name__)
 
-def _bounding_box_from_filename(filename: str, epsg: int = 3857) -> tuple[float, float, float, float]:
-    """Extract tile coordinates from an OAM filename and return the bounding box."""
-    clean = re.sub(r"\.(png|jpeg)$", "", filename)
-    _, *tile_info = re.split("-", clean)
-    x_tile, y_tile, zoom = map(int, tile_info)
-    tile = mercantile.Tile(x=x_tile, y=y_tile, z=zoom)
+TILE_SIZE = 256
 
-    if epsg == 3857:
-        bounds = mercantile.xy_bounds(tile)
-        return bounds.left, bounds.bottom, bounds.right, bounds.top
+# Output directory, file suffix and burn value of each rasterize option. All
+# options are derived from one rasterized footprint per tile.
+RASTERIZE_OPTIONS = {
+    "grayscale": ("grayscale_labels", ".tif", 255),
+    "binary": ("binarymasks", ".mask.tif", 1),
+}
 
-    bounds = mercantile.bounds(tile)
-    return bounds.west, bounds.south, bounds.east, bounds.north
+# Labels handed to each pool worker once by the initializer, so tiles are
+# clipped against a per-process spatial index instead of re-reading the file.
+_worker_labels: geopandas.GeoDataFrame | None = None
+
+
+def _clip_to_bounds(
+    labels: geopandas.GeoDataFrame, bounds: tuple[float, float, float, float]
+) -> geopandas.GeoDataFrame:
+    """Clip the labels to a tile's bounding box.
+
+    Only the candidates returned by the spatial index of ``labels`` are
+    clipped. The index is built once on first access and reused for all
+    tiles, and the output matches ``GeoDataFrame.clip`` feature for feature.
+    """
+    bounding_box_polygon = box(*bounds)
+    candidates = labels.iloc[labels.sindex.query(bounding_box_polygon, predicate="intersects")]
+    if candidates.empty:
+        return candidates
+
+    clipped = candidates.copy()
+    clipped[clipped.geometry.name] = candidates.geometry.intersection(bounding_box_polygon)
+    return clipped
+
+
+def _clip_tile(
+    path: str,
+    bounds: tuple[float, float, float, float],
+    labels: geopandas.GeoDataFrame,
+    output_path: str,
+    rasterize_options: list[str],
+    epsg: int,
+    labels_format: str = "geojson",
+) -> geopandas.GeoDataFrame | None:
+    """Clip the labels for a single tile and write its label and raster outputs.
+
+    With the "parquet" labels format, no GeoJSON is written and the clipped
+    labels are returned with a "tile_id" column for the label store instead.
+    """
+    filename = Path(path).stem
+    clipped_geojson_file = f"{output_path}/labels/{filename}.geojson"
+
+    x_min, y_min, x_max, y_max = bounds
+
+    gdf_clipped = _clip_to_bounds(labels, (x_min, y_min, x_max, y_max))
+    if labels_format == "parquet":
+        store_rows = gdf_clipped.assign(tile_id=filename)
+    elif len(gdf_clipped) > 0:
+        store_rows = None
+        gdf_clipped.to_file(clipped_geojson_file, driver="GeoJSON")
+    else:
+        store_rows = None
+        with open(clipped_geojson_file, "w", encoding="utf-8") as output_file:
+            output_file.write('{"type":"FeatureCollection","name":"labels","features":[]}')
+
+    if not rasterize_options:
+        return store_rows
+
+    transform = from_bounds(x_min, y_min, x_max, y_max, TILE_SIZE, TILE_SIZE)
+    footprint = np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.uint8)
+    if not gdf_clipped.empty:
+        footprint = rasterize_shapes(
+            ((geometry, 1) for geometry in gdf_clipped.geometry),
+            out_shape=footprint.shape,
+            fill=0,
+            transform=transform,
+            dtype=footprint.dtype,
+        )
+
+    _write_masks(output_path, filename, footprint, transform, epsg, rasterize_options)
+    return store_rows
+
+
+def _write_masks(
+    output_path: str,
+    filename: str,
+    footprint: np.ndarray,
+    transform,
+    epsg: int,
+    rasterize_options: list[str],
+) -> None:
+    """Write every requested mask encoding of a tile's 0/1 footprint."""
+    for option in rasterize_options:
+        directory, suffix, burn_value = RASTERIZE_OPTIONS[option]
+        mask = footprint if burn_value == 1 else footprint * np.uint8(burn_value)
+
+        with rasterio.open(
+            f"{output_path}/{directory}/{filename}{suffix}",
+            "w",
+            driver="GTiff",
+            width=mask.shape[1],
+            height=mask.shape[0],
+            count=1,
+            dtype=mask.dtype,
+            crs=f"EPSG:{epsg}",
+            transform=transform,
+        ) as dataset:
+            dataset.write(mask, 1)
+
+
+def _rasterize_mosaic(
+    catalog: TileCatalog,
+    labels: geopandas.GeoDataFrame,
+    output_path: str,
+    rasterize_options: list[str],
+    memory_limit: int,
+) -> None:
+    """Rasterize the labels over the tile grid and cut the tile masks from it.
+
+    Tiles are grouped per zoom level into square blocks of the XYZ grid,
+    sized so that one block's footprint stays below ``memory_limit`` bytes.
+    The labels of each block are burned in a single ``rasterize`` call and
+    every tile's masks are written from a view into that array.
+    """
+    block_size = max(1, math.isqrt(memory_limit // (TILE_SIZE * TILE_SIZE)))
+    tile_bounds = catalog.bounds(epsg=3857)
+
+    blocks = defaultdict(list)
+    for position in range(len(catalog)):
+        key = (int(catalog.z[position]), int(catalog.x[position]) // block_size, int(catalog.y[position]) // block_size)
+        blocks[key].append(position)
+
+    for members in track(blocks.values(), description="Rasterizing label mosaic"):
+        x_start = catalog.x[members].min()
+        y_start = catalog.y[members].min()
+        left = tile_bounds[members, 0].min()
+        bottom = tile_bounds[members, 1].min()
+        right = tile_bounds[members, 2].max()
+        top = tile_bounds[members, 3].max()
+        height = int(catalog.y[members].max() - y_start + 1) * TILE_SIZE
+        width = int(catalog.x[members].max() - x_start + 1) * TILE_SIZE
+
+        mosaic = np.zeros((height, width), dtype=np.uint8)
+        candidates = labels.iloc[labels.sindex.query(box(left, bottom, right, top), predicate="intersects")]
+        if not candidates.empty:
+            mosaic = rasterize_shapes(
+                ((geometry, 1) for geometry in candidates.geometry),
+                out_shape=mosaic.shape,
+                fill=0,
+                transform=from_bounds(left, bottom, right, top, width, height),
+                dtype=mosaic.dtype,
+            )
+
+        for position in members:
+            row = int(catalog.y[position] - y_start) * TILE_SIZE
+            col = int(catalog.x[position] - x_start) * TILE_SIZE
+            footprint = mosaic[row : row + TILE_SIZE, col : col + TILE_SIZE]
+            transform = from_bounds(*tile_bounds[position], TILE_SIZE, TILE_SIZE)
+            filename = Path(catalog.paths[position]).stem
+            _write_masks(output_path, filename, footprint, transform, 3857, rasterize_options)
+
+
+def _init_worker(labels: geopandas.GeoDataFrame) -> None:
+    global _worker_labels
+    _worker_labels = labels
+
+
+def _clip_tile_in_worker(
+    path: str, bounds: tuple[float, float, float, float], **kwargs
+) -> geopandas.GeoDataFrame | None:
+    assert _worker_labels is not None, "Worker was not initialized with labels"
+    return _clip_tile(path, bounds, _worker_labels, **kwargs)
 
 
 def clip_labels(
@@ -36,90 +199,103 @@ def clip_labels(
     rasterize_options: list[str] | None = None,
     all_geojson_file: str | None = None,
     epsg: int = 3857,
+    labels: geopandas.GeoDataFrame | None = None,
+    tiles: TileCatalog | None = None,
+    workers: int = 1,
+    rasterize_mode: str = "tile",
+    mosaic_memory_limit: int = 256 * 1024**2,
+    labels_format: str = "geojson",
 ) -> None:
     """Clip and rasterize the GeoJSON labels for each aerial image.
 
     For each OAM image, the corresponding GeoJSON labels are clipped and
-    saved in the "labels" directory. Optionally rasterized to GeoTIFF.
+    saved in the "labels" directory, or in a single label store. Optionally
+    rasterized to GeoTIFF.
 
     Args:
         input_path: Directory with input PNG images.
         output_path: Directory for output data.
         rasterize: Whether to rasterize clipped labels.
         rasterize_options: List of rasterize modes ("grayscale", "binary").
+            The labels are rasterized once per tile and every requested
+            mode is written from that single footprint.
         all_geojson_file: Path to the GeoJSON file with all labels.
         epsg: EPSG code for the coordinate system.
+        labels: All labels as an already loaded GeoDataFrame in ``epsg``.
+            When given, ``all_geojson_file`` is not read.
+        tiles: Catalog of the PNG tiles to process. Defaults to all PNG
+            tiles in ``input_path``.
+        workers: Number of processes the tiles are sharded across. Each
+            worker receives the loaded labels once and builds its own
+            spatial index. With 1, tiles are processed in this process.
+        rasterize_mode: "tile" rasterizes the clipped labels of each tile
+            separately. "mosaic" burns all labels into the tile grid of
+            each zoom level in a few large calls and slices the tile masks
+            out of it. Mosaic mode needs EPSG:3857, where the XYZ grid is
+            linear, and falls back to "tile" otherwise.
+        mosaic_memory_limit: Maximum size in bytes of one mosaic block. Larger
+            grids are rasterized block by block.
+        labels_format: "geojson" writes one GeoJSON file per tile into the
+            "labels" directory. "parquet" writes the clipped labels of all
+            tiles into a single GeoParquet file, "labels.parquet" in
+            output_path, with a "tile_id" column. Rows are sorted by tile
+            id, so ``label_store.read_label_store`` can read the labels of
+            a few tiles without reading the whole file. Tiles without
+            labels have no rows.
     """
-    output_grayscale_path = ""
-    output_binary_path = ""
+    assert workers >= 1, "workers must be at least 1"
+    assert rasterize_mode in ("tile", "mosaic"), "rasterize_mode must be 'tile' or 'mosaic'"
+    assert labels_format in LABEL_FORMATS, f"labels_format must be one of {LABEL_FORMATS}"
+
+    if rasterize_mode == "mosaic" and epsg != 3857:
+        log.warning("Mosaic rasterization needs EPSG:3857, rasterizing tile by tile instead")
+        rasterize_mode = "tile"
 
     if rasterize:
         assert (
             rasterize_options is not None
             and isinstance(rasterize_options, list)
-            and 0 < len(rasterize_options) <= 2
+            and 0 < len(rasterize_options) <= len(RASTERIZE_OPTIONS)
             and len(rasterize_options) == len(set(rasterize_options))
         ), "Please provide a list with rasterizing options"
 
         for option in rasterize_options:
-            assert option in ("grayscale", "binary"), "Please provide valid rasterizing options"
-
-            if option == "grayscale":
-                output_grayscale_path = f"{output_path}/grayscale_labels"
-                os.makedirs(output_grayscale_path, exist_ok=True)
-
-            if option == "binary":
-                output_binary_path = f"{output_path}/binarymasks"
-                os.makedirs(output_binary_path, exist_ok=True)
-
-    output_geojson_path = f"{output_path}/labels"
-    os.makedirs(output_geojson_path, exist_ok=True)
-
-    png_files = glob(f"{input_path}/*.png")
-    for path in track(png_files, description=f"Clipping labels for {Path(input_path).stem}"):
-        filename = Path(path).stem
-        geojson_file_all_labels = all_geojson_file or f"{output_path}/labels_epsg3857.geojson"
-        clipped_geojson_file = f"{output_geojson_path}/{filename}.geojson"
-
-        x_min, y_min, x_max, y_max = _bounding_box_from_filename(filename, epsg=epsg)
-        bounding_box_polygon = box(x_min, y_min, x_max, y_max)
-
-        gdf_all_labels = geopandas.read_file(os.path.relpath(geojson_file_all_labels))
-        gdf_clipped = gdf_all_labels.clip(bounding_box_polygon)
-        if len(gdf_clipped) > 0:
-            gdf_clipped.to_file(clipped_geojson_file, driver="GeoJSON")
-        else:
-            with open(clipped_geojson_file, "w", encoding="utf-8") as output_file:
-                output_file.write('{"type":"FeatureCollection","name":"labels","features":[]}')
-
-        if rasterize and rasterize_options:
-            for option in rasterize_options:
-                if option == "grayscale":
-                    raster_file = f"{output_grayscale_path}/{filename}.tif"
-                    burn_value = 255
-                else:
-                    raster_file = f"{output_binary_path}/{filename}.mask.tif"
-                    burn_value = 1
-
-                mask = np.zeros((256, 256), dtype=np.uint8)
-                if not gdf_clipped.empty:
-                    mask = rasterize_shapes(
-                        ((geometry, burn_value) for geometry in gdf_clipped.geometry),
-                        out_shape=mask.shape,
-                        fill=0,
-                        transform=from_bounds(x_min, y_min, x_max, y_max, mask.shape[1], mask.shape[0]),
-                        dtype=mask.dtype,
-                    )
-
-                with rasterio.open(
-                    raster_file,
-                    "w",
-                    driver="GTiff",
-                    width=mask.shape[1],
-                    height=mask.shape[0],
-                    count=1,
-                    dtype=mask.dtype,
-                    crs=f"EPSG:{epsg}",
-                    transform=from_bounds(x_min, y_min, x_max, y_max, mask.shape[1], mask.shape[0]),
-                ) as dataset:
-                    dataset.write(mask, 1)
+            assert option in RASTERIZE_OPTIONS, "Please provide valid rasterizing options"
+            os.makedirs(f"{output_path}/{RASTERIZE_OPTIONS[option][0]}", exist_ok=True)
+
+    if labels_format == "geojson":
+        os.makedirs(f"{output_path}/labels", exist_ok=True)
+
+    if labels is not None:
+        gdf_all_labels = labels
+    else:
+        gdf_all_labels = read_labels(all_geojson_file or f"{output_path}/labels_epsg3857.geojson")
+
+    options = (rasterize_options or []) if rasterize else []
+    tile_kwargs = {
+        "output_path": output_path,
+        "rasterize_options": options if rasterize_mode == "tile" else [],
+        "epsg": epsg,
+        "labels_format": labels_format,
+    }
+    catalog = TileCatalog.from_paths(glob(f"{input_path}/*.png")) if tiles is None else tiles
+    tile_bounds = [tuple(bounds) for bounds in catalog.bounds(epsg=epsg).tolist()]
+    description = f"Clipping labels for {Path(input_path).stem}"
+
+    store_frames = []
+    if workers == 1:
+        for path, bounds in track(list(zip(catalog.paths, tile_bounds, strict=True)), description=description):
+            store_frames.append(_clip_tile(path, bounds, gdf_all_labels, **tile_kwargs))
+    else:
+        chunksize = max(1, len(catalog) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(gdf_all_labels,)) as executor:
+            worker = partial(_clip_tile_in_worker, **tile_kwargs)
+            results = executor.map(worker, catalog.paths, tile_bounds, chunksize=chunksize)
+            for frame in track(results, description=description, total=len(catalog)):
+                store_frames.append(frame)
+
+    if labels_format == "parquet":
+        write_label_store(label_store_path(output_path), catalog.tile_ids, store_frames, gdf_all_labels.iloc[0:0])
+
+    if options and rasterize_mode == "mosaic":
+        _rasterize_mosaic(catalog, gdf_all_labels, output_path, options, mosaic_memory_limit)
@@ -1,39 +1,65 @@
 # Third party imports
-import os
-
 import geopandas
-from shapely.validation import explain_validity, make_valid
+import numpy as np
+
+from .read_labels import read_labels
+
+_SINGLE_PART_TYPES = ("Point", "LineString", "LinearRing", "Polygon")
 
 
-def remove_self_intersection(row):
+def remove_self_intersections(geometries: geopandas.GeoSeries) -> geopandas.GeoSeries:
     """Fix self-intersections in the polygons.
 
     Some of the polygons may have self-intersections. In that
     case, we transform that geometry to a multi-polygon and
-    substitute the original geometry with the largest polygon.
+    substitute the original geometry with its dominant part: the
+    first part covering at least half of the original area, or None
+    if there is no such part.
+
+    Validity checks, repairs and the part selection run on the whole
+    geometry array at once instead of row by row.
     """
-    if explain_validity(row.geometry) == "Valid Geometry":
-        return row.geometry
+    invalid = np.flatnonzero(~geometries.is_valid.to_numpy())
+    if len(invalid) == 0:
+        return geometries
+
+    # Areas are only compared with each other, so the CRS is not carried over
+    original = geopandas.GeoSeries(list(geometries.values[invalid]))
+    repaired = original.make_valid()
 
-    valid_geom = make_valid(row.geometry)
-    if not hasattr(valid_geom, "__len__"):
-        return valid_geom
+    # Index of the exploded parts is the position in ``original``, in part order
+    parts = repaired.explode(index_parts=False)
+    half_area = original.area.to_numpy()[parts.index.to_numpy()] / 2.0
+    dominant = parts[parts.area.to_numpy() >= half_area]
+    dominant = dominant[~dominant.index.duplicated()].reindex(repaired.index)
 
-    for polygon in valid_geom.geoms:
-        if polygon.area >= row.geometry.area / 2.0:
-            return polygon
+    single_part = repaired.geom_type.isin(_SINGLE_PART_TYPES).to_numpy()
+    fixed = geometries.copy()
+    fixed.iloc[invalid] = np.where(single_part, repaired.to_numpy(), dominant.to_numpy())
+    return fixed
 
 
-def fix_labels(input_path: str, output_path: str) -> None:
+def fix_labels(
+    input_path: str,
+    output_path: str | None = None,
+    bbox: tuple[float, float, float, float] | None = None,
+) -> geopandas.GeoDataFrame:
     """Fix GeoJSON file so that it doesn't have any self-intersecting polygons.
 
     Args:
         input_path: Path to the GeoJSON file where the input data are stored.
         output_path: Path to the GeoJSON file where the output data will go.
+            If None, the fixed labels are only returned.
+        bbox: Optional (minx, miny, maxx, maxy) in EPSG:4326. Only the labels
+            intersecting it are read and fixed.
+
+    Returns:
+        The fixed labels.
     """
-    gdf = geopandas.read_file(os.path.relpath(input_path))
-    # print(gdf)
+    gdf = read_labels(input_path, bbox=bbox)
     if gdf.empty:
         raise ValueError("Error: gdf is empty, No Labels found : Check your labels")
-    gdf["geometry"] = gdf.apply(remove_self_intersection, axis=1)
-    gdf.to_file(output_path, driver="GeoJSON")
+    gdf["geometry"] = remove_self_intersections(gdf.geometry)
+    if output_path is not None:
+        gdf.to_file(output_path, driver="GeoJSON")
+    return gdf
@@ -0,0 +1,97 @@
+import os
+
+import geopandas
+import pandas
+
+from .._logging import get_logger
+from ..utils import atomic_write
+
+log = get_logger(__name__)
+
+LABEL_STORE_FILENAME = "labels.parquet"
+LABEL_FORMATS = ("geojson", "parquet")
+
+# Rows are sorted by tile id before writing, so the min/max statistics of
+# each row group let a per-tile filter skip most of the file.
+ROW_GROUP_SIZE = 10_000
+
+
+def label_store_path(output_path: str) -> str:
+    """Return the path of the label store of a preprocessed directory."""
+    return os.path.join(output_path, LABEL_STORE_FILENAME)
+
+
+def read_label_store(path: str, tile_ids: list[str] | None = None) -> geopandas.GeoDataFrame:
+    """Read the clipped labels of a label store, optionally only those of some tiles.
+
+    Args:
+        path: Path of the GeoParquet label store.
+        tile_ids: Tile ids to read, e.g. "OAM-x-y-z". Reads all tiles if None.
+
+    Returns:
+        The clipped labels with their "tile_id" column. Tiles without labels
+        have no rows.
+    """
+    if tile_ids is None:
+        filters = None
+    elif len(tile_ids):
+        filters = [("tile_id", "in", list(tile_ids))]
+    else:
+        # pyarrow rejects an empty "in" list; no tile id sorts before "", so this keeps the schema and no rows
+        filters = [("tile_id", "<", "")]
+    return geopandas.read_parquet(path, filters=filters)
+
+
+def _write_store(path: str, store: geopandas.GeoDataFrame) -> None:
+    with atomic_write(path) as temp_path:
+        store.to_parquet(temp_path, index=False, row_group_size=ROW_GROUP_SIZE)
+
+
+def write_label_store(
+    path: str,
+    tile_ids: list[str],
+    frames: list[geopandas.GeoDataFrame],
+    template: geopandas.GeoDataFrame,
+) -> None:
+    """Write the clipped labels of several tiles into a label store.
+
+    Rows already in the store for tiles other than ``tile_ids`` are kept,
+    so a subset of the tiles can be rewritten.
+
+    Args:
+        path: Path of the GeoParquet label store.
+        tile_ids: Ids of the processed tiles.
+        frames: Clipped labels of the processed tiles, with a "tile_id" column.
+        template: Empty frame with the columns and CRS of the labels, used
+            when no tile has labels.
+    """
+    if not tile_ids and os.path.isfile(path):
+        return
+
+    frames = list(frames)
+    if os.path.isfile(path):
+        existing = read_label_store(path)
+        frames.insert(0, existing[~existing["tile_id"].isin(set(tile_ids))])
+
+    frames = [frame for frame in frames if not frame.empty]
+    if frames:
+        store = geopandas.GeoDataFrame(pandas.concat(frames, ignore_index=True), crs=template.crs)
+    else:
+        store = template.assign(tile_id=pandas.Series(dtype=str))
+    store = store.sort_values("tile_id", kind="stable", ignore_index=True)
+
+    _write_store(path, store)
+    log.info("Wrote %d labels of %d tiles to %s", len(store), store["tile_id"].nunique(), path)
+
+
+def remove_store_tiles(path: str, tile_ids: set[str]) -> None:
+    """Drop the labels of some tiles from a label store, if it exists."""
+    if not tile_ids or not os.path.isfile(path):
+        return
+
+    existing = read_label_store(path)
+    kept = existing[~existing["tile_id"].isin(tile_ids)]
+    if len(kept) == len(existing):
+        return
+
+    _write_store(path, kept)
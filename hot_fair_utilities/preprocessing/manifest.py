@@ -0,0 +1,125 @@
+import hashlib
+import json
+from pathlib import Path
+
+import geopandas
+
+from .._logging import get_logger, track
+from ..tile_catalog import TileCatalog
+from ..utils import atomic_write
+from .clip_labels import RASTERIZE_OPTIONS, _clip_to_bounds
+from .label_store import label_store_path, remove_store_tiles
+
+log = get_logger(__name__)
+
+MANIFEST_FILENAME = "preprocess_manifest.json"
+
+# Per-tile outputs of preprocess, as (directory, file suffix); the raster labels follow RASTERIZE_OPTIONS
+TILE_OUTPUTS = (
+    ("chips", ".tif"),
+    ("labels", ".geojson"),
+    *((directory, suffix) for directory, suffix, _ in RASTERIZE_OPTIONS.values()),
+    ("multimasks", ".mask.tif"),
+)
+
+
+def file_digest(path: str) -> str:
+    """Return the SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def labels_digest(labels: geopandas.GeoDataFrame) -> str:
+    """Return the SHA-256 hex digest of the geometries and attributes of the labels.
+
+    The digest does not depend on the order of the features.
+    """
+    attributes = labels.drop(columns=labels.geometry.name).to_dict(orient="records")
+    feature_digests = sorted(
+        hashlib.sha256((wkb or b"") + json.dumps(record, sort_keys=True, default=str).encode()).digest()
+        for wkb, record in zip(labels.geometry.to_wkb(), attributes, strict=True)
+    )
+    return hashlib.sha256(b"".join(feature_digests)).hexdigest()
+
+
+def load_manifest(output_path: str, filename: str = MANIFEST_FILENAME) -> dict:
+    """Load the manifest of a previous run, or an empty one."""
+    manifest_path = Path(output_path) / filename
+    if not manifest_path.is_file():
+        return {"parameters": None, "tiles": {}}
+    with manifest_path.open() as file:
+        return json.load(file)
+
+
+def save_manifest(
+    output_path: str, parameters: dict, tiles: dict[str, dict], filename: str = MANIFEST_FILENAME
+) -> None:
+    """Write the manifest of this run."""
+    with atomic_write(Path(output_path) / filename) as temp_path, open(temp_path, "w") as file:
+        json.dump({"parameters": parameters, "tiles": tiles}, file, indent=2, sort_keys=True)
+
+
+def remove_tile_outputs(output_path: str, tile_id: str) -> None:
+    """Delete every preprocess output of a tile."""
+    for directory, suffix in TILE_OUTPUTS:
+        Path(output_path, directory, f"{tile_id}{suffix}").unlink(missing_ok=True)
+
+
+def select_changed_tiles(
+    output_path: str,
+    catalog: TileCatalog,
+    labels: geopandas.GeoDataFrame,
+    parameters: dict,
+    epsg: int,
+) -> tuple[TileCatalog, dict[str, dict[str, str]]]:
+    """Find the tiles whose outputs have to be regenerated.
+
+    A tile is regenerated when its image or the labels within its bounding
+    box changed since the last run, or when the preprocessing parameters
+    changed. Outputs of changed tiles and of tiles that no longer exist in
+    the input are deleted, and so is the label store when the labels are
+    no longer written in the parquet format.
+
+    Args:
+        output_path: Directory of the preprocessed data and the manifest.
+        catalog: Catalog of all input PNG tiles.
+        labels: Fixed labels in ``epsg``.
+        parameters: Preprocessing parameters of this run.
+        epsg: EPSG code of ``labels``.
+
+    Returns:
+        A catalog of the tiles to process, and the manifest entries of all
+        tiles to save once they are processed.
+    """
+    previous = load_manifest(output_path)
+
+    tiles = {}
+    tile_ids = catalog.tile_ids
+    tile_bounds = catalog.bounds(epsg=epsg)
+    for position in track(range(len(catalog)), description="Hashing tiles"):
+        tile_labels = _clip_to_bounds(labels, tuple(tile_bounds[position]))
+        tiles[tile_ids[position]] = {
+            "image": file_digest(catalog.paths[position]),
+            "labels": labels_digest(tile_labels),
+        }
+
+    if previous["parameters"] == parameters:
+        changed = [
+            position for position, tile_id in enumerate(tile_ids) if previous["tiles"].get(tile_id) != tiles[tile_id]
+        ]
+    else:
+        changed = list(range(len(catalog)))
+    removed = set(previous["tiles"]) - set(tiles)
+
+    for tile_id in removed | {tile_ids[position] for position in changed}:
+        remove_tile_outputs(output_path, tile_id)
+    if parameters["labels_format"] != "parquet":
+        Path(label_store_path(output_path)).unlink(missing_ok=True)
+    else:
+        remove_store_tiles(label_store_path(output_path), removed)
+
+    log.info("%d of %d tiles changed, %d removed", len(changed), len(catalog), len(removed))
+    return catalog.subset(changed), tiles
@@ -1,31 +1,177 @@
-# Patched from ramp-code.scripts.multi_masks_from_polygons created for ramp project by carolyn.johnston@dev.global
+# Replaces ramp-code.scripts.multi_masks_from_polygons created for ramp project by carolyn.johnston@dev.global
 
 # Standard library imports
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from glob import glob
 from pathlib import Path
 
 # Third party imports
 import geopandas as gpd
+import numpy as np
 import rasterio as rio
-from ramp.data_mgmt.chip_label_pairs import (
-    construct_mask_filepath,
-    get_tq_chip_label_pairs,
-)
-from ramp.utils.img_utils import to_channels_first
-from ramp.utils.multimask_utils import df_to_px_mask, multimask_to_sparse_multimask
-from solaris.utils.core import _check_rasterio_im_load
-from solaris.utils.geo import get_crs
-from solaris.vector.mask import crs_is_metric
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.features import rasterize
 
-from .._logging import track
+from .._logging import get_logger, track
+from ..utils import atomic_write
+from .chip_index import chip_metadata
+from .label_store import read_label_store
 
+log = get_logger(__name__)
 
-def get_rasterio_shape_and_transform(image_path):
-    # get the image shape and the affine transform to pass into df_to_px_mask.
-    with rio.open(image_path) as rio_dset:
-        shape = rio_dset.shape
-        transform = rio_dset.transform
-    return shape, transform
+# Sparse multimask values. Where the channels overlap, boundary wins over
+# footprint and footprint over contact, as in ramp's multimask_to_sparse_multimask.
+BACKGROUND, FOOTPRINT, BOUNDARY, CONTACT = 0, 1, 2, 3
+
+
+def _to_pixels(geometries: gpd.GeoSeries, transform: Affine) -> gpd.GeoSeries:
+    """Return the geometries in the pixel coordinates of transform."""
+    inverse = ~transform
+    return geometries.affine_transform([inverse.a, inverse.b, inverse.d, inverse.e, inverse.xoff, inverse.yoff])
+
+
+def _burn(geometries: gpd.GeoSeries, shape) -> np.ndarray:
+    """Return the pixels whose centres fall in any of the pixel-space geometries."""
+    if len(geometries) == 0:
+        return np.zeros(shape, dtype=bool)
+    return rasterize(geometries, out_shape=shape, fill=0, default_value=1, dtype=np.uint8).astype(bool)
+
+
+def _contact_geometries(polygons: gpd.GeoSeries, contact_spacing: float) -> gpd.GeoSeries:
+    """Return the intersections of the buffers of each pair of polygons in contact.
+
+    Two polygons are in contact when the contact_spacing buffer of one
+    overlaps the other, as in ramp's get_contact_dataframe.
+    """
+    buffered = polygons.buffer(contact_spacing)
+    buffer_index, polygon_index = buffered.sindex.query(polygons, predicate="intersects")[::-1]
+    pairs = buffer_index != polygon_index
+    buffer_index, polygon_index = buffer_index[pairs], polygon_index[pairs]
+
+    # ramp overlays the buffers with the polygons, which drops the pairs
+    # that only share an edge or a corner
+    overlap = (
+        buffered.iloc[buffer_index]
+        .reset_index(drop=True)
+        .intersection(polygons.iloc[polygon_index].reset_index(drop=True))
+        .area
+        > 0
+    )
+    pairs = {tuple(sorted(pair)) for pair in zip(buffer_index[overlap], polygon_index[overlap], strict=True)}
+    if not pairs:
+        return buffered.iloc[0:0]
+
+    first, second = (list(index) for index in zip(*sorted(pairs), strict=True))
+    return buffered.iloc[first].reset_index(drop=True).intersection(buffered.iloc[second].reset_index(drop=True))
+
+
+def multimask_from_geometries(geometries, transform, shape, boundary_width=3, contact_spacing=8):
+    """Create a sparse multimask from polygons.
+
+    This reproduces ramp's df_to_px_mask with pixel units, with the
+    polygons buffered in pixel coordinates:
+
+    - footprint: pixels whose centre falls in a polygon
+    - boundary: footprint pixels outside the polygons shrunk by boundary_width
+    - contact: pixels in the intersection of the contact_spacing buffers of
+      two polygons, where the buffer of one overlaps the other
+
+    Args:
+        geometries: Polygons or multipolygons in the CRS of ``transform``.
+            Each part of a multipolygon is a separate building.
+        transform: Affine transform of the mask.
+        shape: (height, width) of the mask.
+        boundary_width: Pixel width of the boundary inner buffer.
+        contact_spacing: Pixel distance threshold for contact labeling.
+
+    Returns:
+        A uint8 array of ``shape`` with BACKGROUND, FOOTPRINT, BOUNDARY and
+        CONTACT values.
+    """
+    geometries = gpd.GeoSeries(list(geometries))
+    geometries = geometries[~(geometries.isna() | geometries.is_empty)]
+
+    sparse_mask = np.zeros(shape, dtype=np.uint8)
+    if len(geometries) == 0:
+        return sparse_mask
+
+    # buffer(0) repairs invalid polygons, which may split them into parts
+    polygons = _to_pixels(geometries, transform).buffer(0).explode(ignore_index=True)
+    polygons = polygons[~polygons.is_empty].reset_index(drop=True)
+
+    interiors = polygons.buffer(-boundary_width)
+    footprint = _burn(polygons, shape)
+    boundary = footprint & ~_burn(interiors[~interiors.is_empty], shape)
+
+    sparse_mask[_burn(_contact_geometries(polygons, contact_spacing), shape)] = CONTACT
+    sparse_mask[footprint] = FOOTPRINT
+    sparse_mask[boundary] = BOUNDARY
+    return sparse_mask
+
+
+def _write_multimask(
+    labels,
+    metadata,
+    mask_path,
+    input_contact_spacing,
+    input_boundary_width,
+):
+    """Write the sparse multimask of one chip.
+
+    The mask is written atomically, so an interrupted run never leaves a
+    partial mask that a resumed run would take as done.
+
+    Args:
+        labels: Path of the chip's GeoJSON label file, or its labels as a GeoDataFrame.
+        metadata: Metadata of the chip, as returned by chip_index.read_chip_metadata.
+        mask_path: Path of the output mask.
+        input_contact_spacing: Pixel distance threshold for contact mask labeling.
+        input_boundary_width: Pixel width of boundary inner buffer.
+    """
+    gdf = gpd.read_file(os.path.relpath(labels)) if isinstance(labels, str) else labels
+
+    # remove empty and null geometries
+    gdf = gdf[~gdf["geometry"].isna()]
+    gdf = gdf[~gdf.is_empty]
+
+    crs = CRS.from_string(metadata["crs"])
+    transform = Affine(*metadata["transform"])
+    if gdf.crs is not None and gdf.crs != crs:
+        gdf = gdf.to_crs(crs)
+
+    # The solaris implementation this replaces buffered contacts in
+    # pixel units, but was given the spacing in meters for metric
+    # CRSs. Keep that spacing so existing training data is reproduced.
+    # Its boundary width was in meters too, which on the square pixels
+    # of metric chips is the same width in pixels.
+    contact_spacing = input_contact_spacing
+    if crs.linear_units in ("metre", "meter"):
+        contact_spacing = min(metadata["res"]) * input_contact_spacing
+
+    sparse_multi_mask = multimask_from_geometries(
+        gdf.geometry,
+        transform,
+        (metadata["height"], metadata["width"]),
+        boundary_width=input_boundary_width,
+        contact_spacing=contact_spacing,
+    )
+
+    # write out sparse mask file with rasterio.
+    meta = {
+        "driver": "GTiff",
+        "count": 1,
+        "dtype": "uint8",
+        "nodata": None,
+        "width": metadata["width"],
+        "height": metadata["height"],
+        "crs": crs,
+        "transform": transform,
+    }
+    with atomic_write(mask_path) as temp_path, rio.open(temp_path, "w", **meta) as dst:
+        dst.write(sparse_multi_mask, 1)
 
 
 def multimasks_from_polygons(
@@ -34,18 +180,32 @@ def multimasks_from_polygons(
     out_mask_dir,
     input_contact_spacing=8,
     input_boundary_width=3,
+    label_store=None,
+    workers=1,
+    chip_index=None,
 ):
     """Create multichannel building footprint masks from geojson polygons.
 
     Units are in pixels because meter-based spacing would not maintain
     consistency across zoom levels (pixel resolution varies).
 
+    Masks that already exist are skipped, so an interrupted run can be
+    resumed.
+
     Args:
         in_poly_dir: Directory containing geojson label files.
         in_chip_dir: Directory containing image chips matching geojson files.
         out_mask_dir: Directory for output SDT masks.
         input_contact_spacing: Pixel distance threshold for contact mask labeling.
         input_boundary_width: Pixel width of boundary inner buffer.
+        label_store: Path of a GeoParquet label store written by clip_labels.
+            When given, the labels of each chip are read from it and
+            in_poly_dir is not used.
+        workers: Number of processes the chips are distributed across. With
+            1, chips are processed in this process.
+        chip_index: Path of the chip index written by preprocess. The shape,
+            transform and CRS of the chips are read from it instead of
+            opening each chip.
 
     Example:
         multimasks_from_polygons(
@@ -54,86 +214,55 @@ def multimasks_from_polygons(
             "data/preprocessed/multimasks"
         )
     """
+    assert workers >= 1, "workers must be at least 1"
 
     # If output mask directory doesn't exist, try to create it.
     Path(out_mask_dir).mkdir(parents=True, exist_ok=True)
 
-    chip_label_pairs = get_tq_chip_label_pairs(in_chip_dir, in_poly_dir)
-
-    chip_paths, label_paths = list(zip(*chip_label_pairs, strict=True))
+    if label_store is None:
+        label_paths = sorted(glob(os.path.join(in_poly_dir, "*.geojson")))
+        chip_paths = [os.path.join(in_chip_dir, f"{Path(label_path).stem}.tif") for label_path in label_paths]
+    else:
+        chip_paths = sorted(glob(os.path.join(in_chip_dir, "*.tif")))
 
-    # construct the output mask file names from the chip file names.
-    # these will have the same base filenames as the chip files,
+    # The output masks have the same base filenames as the chip files,
     # with a mask.tif extension in place of the .tif extension.
+    mask_paths = [os.path.join(out_mask_dir, f"{Path(chip_path).stem}.mask.tif") for chip_path in chip_paths]
 
-    mask_paths = [construct_mask_filepath(out_mask_dir, chip_path) for chip_path in chip_paths]
-
-    # construct a list of full paths to the mask files
-    json_chip_mask_zips = zip(label_paths, chip_paths, mask_paths, strict=True)
-    for json_path, chip_path, mask_path in track(list(json_chip_mask_zips), description="Generating multimasks"):
-        # We will run this on very large directories, and some label files might fail to process.
-        # We want to be able to resume mask creation from where we left off.
-        if Path(mask_path).is_file():
-            continue
-
-        # workaround for bug in solaris
-        mask_shape, _mask_transform = get_rasterio_shape_and_transform(chip_path)
-
-        gdf = gpd.read_file(os.path.relpath(json_path))
-
-        # remove empty and null geometries
-        gdf = gdf[~gdf["geometry"].isna()]
-        gdf = gdf[~gdf.is_empty]
-
-        reference_im = _check_rasterio_im_load(chip_path)
-
-        if get_crs(gdf) != get_crs(reference_im):
-            # BUGFIX: if crs's don't match, reproject the geodataframe
-            gdf = gdf.to_crs(get_crs(reference_im))
-
-        if crs_is_metric(gdf):
-            meters = True
-
-            boundary_width = min(reference_im.res) * input_boundary_width
-            contact_spacing = min(reference_im.res) * input_contact_spacing
-
-        else:
-            meters = False
-            boundary_width = input_boundary_width
-            contact_spacing = input_contact_spacing
-
-        # NOTE: solaris does not support multipolygon geodataframes
-        # So first we call explode() to turn multipolygons into polygon dataframes
-        # ignore_index=True prevents polygons from the same multipolygon from being grouped into a series. -+
-        gdf_poly = gdf.explode(ignore_index=True)
-
-        # multi_mask is a one-hot, channels-last encoded mask
-
-        onehot_multi_mask = df_to_px_mask(
-            df=gdf_poly,
-            out_file=mask_path,
-            shape=mask_shape,
-            do_transform=True,
-            affine_obj=None,
-            channels=["footprint", "boundary", "contact"],
-            reference_im=reference_im,
-            boundary_width=boundary_width,
-            contact_spacing=contact_spacing,
-            out_type="uint8",
-            meters=meters,
-        )
+    # We will run this on very large directories, and some label files might fail to process.
+    # We want to be able to resume mask creation from where we left off.
+    pending = [position for position, mask_path in enumerate(mask_paths) if not Path(mask_path).is_file()]
+    chip_paths = [chip_paths[position] for position in pending]
+    mask_paths = [mask_paths[position] for position in pending]
+    if not pending:
+        log.info("All multimasks in %s already exist", out_mask_dir)
+        return
+
+    if label_store is None:
+        labels = [label_paths[position] for position in pending]
+    else:
+        tile_ids = [Path(chip_path).stem for chip_path in chip_paths]
+        store_labels = read_label_store(label_store, tile_ids)
+        tile_labels = dict(tuple(store_labels.groupby("tile_id")))
+        labels = [tile_labels.get(tile_id, store_labels.iloc[0:0]) for tile_id in tile_ids]
 
-        # convert onehot_multi_mask to a sparse encoded mask
-        # of shape (1,H,W) for compatibility with rasterio writer
-        sparse_multi_mask = multimask_to_sparse_multimask(onehot_multi_mask)
-        sparse_multi_mask = to_channels_first(sparse_multi_mask)
+    metadata = chip_metadata(chip_paths, chip_index)
 
-        # write out sparse mask file with rasterio.
-        with rio.open(chip_path, "r") as src:
-            meta = src.meta.copy()
-            meta.update(count=sparse_multi_mask.shape[0])
+    write = partial(
+        _write_multimask,
+        input_contact_spacing=input_contact_spacing,
+        input_boundary_width=input_boundary_width,
+    )
+    description = "Generating multimasks"
 
-            meta.update(dtype="uint8")
-            meta.update(nodata=None)
-            with rio.open(mask_path, "w", **meta) as dst:
-                dst.write(sparse_multi_mask)
+    if workers == 1:
+        for label, chip_meta, mask_path in track(
+            list(zip(labels, metadata, mask_paths, strict=True)), description=description
+        ):
+            write(label, chip_meta, mask_path)
+    else:
+        chunksize = max(1, len(chip_paths) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(write, labels, metadata, mask_paths, chunksize=chunksize)
+            for _ in track(results, description=description, total=len(chip_paths)):
+                pass
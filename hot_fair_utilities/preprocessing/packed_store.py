@@ -0,0 +1,188 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+
+import numpy as np
+import rasterio
+
+from .._logging import get_logger, track
+from ..utils import atomic_write
+from .chip_index import chip_index_path, load_chip_index
+
+log = get_logger(__name__)
+
+PACKED_DIRNAME = "packed"
+PACKED_INDEX_FILENAME = "index.json"
+
+# Mask directories of preprocess that are packed when present, as (directory, file suffix)
+PACKED_MASKS = (
+    ("binarymasks", ".mask.tif"),
+    ("multimasks", ".mask.tif"),
+)
+
+
+def packed_store_path(output_path: str) -> str:
+    """Return the path of the packed store of a preprocessed directory."""
+    return os.path.join(output_path, PACKED_DIRNAME)
+
+
+def _pack_range(
+    positions: range,
+    tile_ids: list[str],
+    array_path: str,
+    directory: str,
+    suffix: str,
+) -> None:
+    """Read the rasters of some tiles into their rows of an open .npy array file."""
+    array = np.load(array_path, mmap_mode="r+")
+    for position in positions:
+        with rasterio.open(os.path.join(directory, f"{tile_ids[position]}{suffix}")) as src:
+            # Assigning wider values to the array would silently truncate them
+            if set(src.dtypes) != {array.dtype.name}:
+                raise ValueError(f"{src.name} has dtype {', '.join(set(src.dtypes))}, expected {array.dtype.name}")
+            pixels = src.read()
+        array[position] = np.moveaxis(pixels, 0, -1) if array.ndim == 4 else pixels[0]
+    array.flush()
+
+
+def _pack_rasters(
+    tile_ids: list[str],
+    directory: str,
+    suffix: str,
+    array_path: str,
+    shape: tuple[int, ...],
+    workers: int,
+    description: str,
+) -> None:
+    """Pack one raster per tile into a uint8 .npy array file."""
+    chunk = max(1, len(tile_ids) // (workers * 4))
+    ranges = [range(start, min(start + chunk, len(tile_ids))) for start in range(0, len(tile_ids), chunk)]
+
+    with atomic_write(array_path) as temp_path:
+        np.lib.format.open_memmap(temp_path, mode="w+", dtype=np.uint8, shape=(len(tile_ids), *shape)).flush()
+        pack = partial(_pack_range, tile_ids=tile_ids, array_path=temp_path, directory=directory, suffix=suffix)
+        if workers == 1:
+            for positions in track(ranges, description=description):
+                pack(positions)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for _ in track(executor.map(pack, ranges), description=description, total=len(ranges)):
+                    pass
+
+
+def pack_preprocessed(output_path: str, workers: int = 1) -> str:
+    """Pack the chips and masks of a preprocessed directory into memory-mappable arrays.
+
+    The chips are packed into "chips.npy", a uint8 array of shape
+    (N, height, width, bands), and each mask directory that exists
+    ("binarymasks", "multimasks") into "<directory>.npy" of shape
+    (N, height, width). Row i of every array belongs to the i-th tile id of
+    "index.json". The tiles are those of the chip index, sorted by tile id.
+    Rasters of any other dtype than uint8 raise a ValueError.
+
+    Args:
+        output_path: Directory of the preprocessed data, with the chips and
+            their chip index.
+        workers: Number of processes reading the rasters.
+
+    Returns:
+        The path of the packed store, "packed" in output_path.
+    """
+    assert workers >= 1, "workers must be at least 1"
+    index = load_chip_index(chip_index_path(output_path))
+    assert index, "No chip index found. Preprocess with georeference_images=True."
+
+    tile_ids = sorted(index)
+    shapes = {(entry["height"], entry["width"], entry["count"]) for entry in index.values()}
+    assert len(shapes) == 1, f"All chips must have the same shape to be packed, found {sorted(shapes)}"
+    height, width, bands = shapes.pop()
+
+    store_path = packed_store_path(output_path)
+    os.makedirs(store_path, exist_ok=True)
+
+    _pack_rasters(
+        tile_ids,
+        os.path.join(output_path, "chips"),
+        ".tif",
+        os.path.join(store_path, "chips.npy"),
+        (height, width, bands),
+        workers,
+        "Packing chips",
+    )
+
+    masks = []
+    for directory, suffix in PACKED_MASKS:
+        mask_dir = os.path.join(output_path, directory)
+        if not os.path.isdir(mask_dir):
+            continue
+        missing = [tile_id for tile_id in tile_ids if not os.path.isfile(os.path.join(mask_dir, f"{tile_id}{suffix}"))]
+        assert not missing, f"{len(missing)} chips have no mask in {mask_dir}, e.g. {missing[0]}"
+        _pack_rasters(
+            tile_ids,
+            mask_dir,
+            suffix,
+            os.path.join(store_path, f"{directory}.npy"),
+            (height, width),
+            workers,
+            f"Packing {directory}",
+        )
+        masks.append(directory)
+
+    # The index is written last, so a store with an index is complete
+    with atomic_write(os.path.join(store_path, PACKED_INDEX_FILENAME)) as temp_path, open(temp_path, "w") as file:
+        json.dump({"tile_ids": tile_ids, "masks": masks}, file, indent=1)
+
+    log.info("Packed %d chips and %s into %s", len(tile_ids), ", ".join(masks) or "no masks", store_path)
+    return store_path
+
+
+@dataclass
+class PackedStore:
+    """Chips and masks packed by pack_preprocessed, memory-mapped read-only.
+
+    Rows are only read from disk when accessed, and slices of consecutive
+    rows are views of the files rather than copies.
+
+    Example::
+
+        store = PackedStore.open("data/preprocessed/packed")
+        chips, masks = store.chips[0:8], store.masks["binarymasks"][0:8]
+        chip = store.chips[store.position("OAM-x-y-z")]
+    """
+
+    path: str
+    tile_ids: list[str]
+    chips: np.ndarray
+    masks: dict[str, np.ndarray]
+    _positions: dict[str, int] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self._positions = {tile_id: position for position, tile_id in enumerate(self.tile_ids)}
+
+    @classmethod
+    def open(cls, path: str) -> "PackedStore":
+        """Memory-map a packed store."""
+        with open(os.path.join(path, PACKED_INDEX_FILENAME)) as file:
+            index = json.load(file)
+        chips = np.load(os.path.join(path, "chips.npy"), mmap_mode="r")
+        masks = {mask: np.load(os.path.join(path, f"{mask}.npy"), mmap_mode="r") for mask in index["masks"]}
+        assert all(len(array) == len(index["tile_ids"]) for array in (chips, *masks.values())), (
+            f"Arrays of {path} do not match its index"
+        )
+        return cls(path, index["tile_ids"], chips, masks)
+
+    def __len__(self) -> int:
+        return len(self.tile_ids)
+
+    def __contains__(self, tile_id: str) -> bool:
+        return tile_id in self._positions
+
+    def position(self, tile_id: str) -> int:
+        """Return the row of a tile in the arrays."""
+        return self._positions[tile_id]
+
+    def positions(self, tile_ids) -> np.ndarray:
+        """Return the rows of some tiles, e.g. of a training split."""
+        return np.array([self._positions[tile_id] for tile_id in tile_ids], dtype=np.int64)
@@ -1,12 +1,27 @@
 import os
+import tempfile
 
 from geomltoolkits import georeference_prediction_tiles
 
-from .clip_labels import clip_labels
+from ..tile_catalog import TileCatalog
+from .chip_index import chip_index_path, update_chip_index
+from .clip_labels import RASTERIZE_OPTIONS, clip_labels
 from .fix_labels import fix_labels
+from .label_store import LABEL_FORMATS, label_store_path
+from .manifest import save_manifest, select_changed_tiles
+from .multimasks_from_polygons import multimasks_from_polygons
+from .packed_store import pack_preprocessed
 from .reproject_labels import reproject_labels_to_epsg3857
 
 
+def _georeference_tiles(tiles: TileCatalog, output_path: str, epsg: int) -> None:
+    """Georeference a subset of the OAM images into the "chips" directory."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for path in tiles.paths:
+            os.symlink(os.path.abspath(path), os.path.join(tmp_dir, os.path.basename(path)))
+        georeference_prediction_tiles(tmp_dir, f"{output_path}/chips", crs=str(epsg), clip_bands_to=3)
+
+
 def preprocess(
     input_path: str,
     output_path: str,
@@ -17,6 +32,12 @@ def preprocess(
     input_contact_spacing=8,  # only required if multimasks is set to true
     input_boundary_width=3,  # only required if mulltimasks is set to true
     epsg=3857,
+    workers=1,
+    rasterize_mode="tile",
+    keep_intermediate_files=False,
+    incremental=False,
+    labels_format="geojson",
+    pack=False,
 ) -> None:
     """Fully preprocess the input data.
 
@@ -30,7 +51,8 @@ def preprocess(
             data. New directories will be created in this directory:
             "labels" - for the clipped GeoJSON labels,
             "chips" - for the georeferenced OAM images
-            (if georeference_images=True), and the directories
+            (if georeference_images=True) with their metadata in
+            "chip_index.json", and the directories
             "binarymasks" and "grayscale_labels" if the corresponding
             rasterizing options are chosen.
             "multimasks" - for the multimasks labels (if multimasks=True)
@@ -52,6 +74,30 @@ def preprocess(
         Units are in pixels because meter-based spacing would not maintain
         consistency across zoom levels (pixel resolution varies).
 
+        epsg: EPSG code of the output data, 3857 or 4326.
+        workers: Number of processes used to clip and rasterize the tiles,
+            to generate the multimasks and to pack the chips.
+        rasterize_mode: "tile" to rasterize each tile separately, or "mosaic"
+            to burn the labels once over the tile grid and slice the tile
+            masks out of it (EPSG:3857 only).
+        keep_intermediate_files: Debug option. The fixed and reprojected
+            labels are passed between the stages in memory; set this to
+            also write them to "corrected_labels.geojson" and
+            "labels_epsg3857.geojson" in output_path.
+        incremental: Keep a manifest in output_path with the content hash
+            of each input tile, the hash of the labels within its bounding
+            box and the preprocessing parameters. On a rerun only the
+            outputs of new or changed tiles are regenerated, and outputs of
+            tiles removed from the input are deleted.
+        labels_format: "geojson" to write the clipped labels of each tile to
+            its own file in "labels", or "parquet" to write the clipped
+            labels of all tiles into a single "labels.parquet" file in
+            output_path with a "tile_id" column. The multimasks and
+            yolo_format read either format.
+        pack: Also pack the chips and masks into memory-mappable arrays in
+            "packed" (see packed_store.pack_preprocessed), for training
+            without opening every GeoTIFF. Requires georeference_images=True.
+
     Example::
 
         preprocess(
@@ -64,33 +110,55 @@ def preprocess(
     """
     # Check if rasterizing options are valid
     assert epsg in (4326, 3857), "Projection not supported"
+    assert labels_format in LABEL_FORMATS, f"labels_format must be one of {LABEL_FORMATS}"
     if rasterize:
         assert (
             rasterize_options is not None
             and isinstance(rasterize_options, list)
-            and 0 < len(rasterize_options) <= 2
+            and 0 < len(rasterize_options) <= len(RASTERIZE_OPTIONS)
             and len(rasterize_options) == len(set(rasterize_options))
         ), "Please provide a list with rasterizing options"
 
         for option in rasterize_options:
-            assert option in (
-                "grayscale",
-                "binary",
-            ), "Please provide a list with valid rasterizing options"
+            assert option in RASTERIZE_OPTIONS, "Please provide a list with valid rasterizing options"
 
     os.makedirs(output_path, exist_ok=True)
 
-    if georeference_images:
-        georeference_prediction_tiles(input_path, f"{output_path}/chips", crs=str(epsg), clip_bands_to=3)
-
-    fix_labels(
+    # Only read the labels that fall within the tiles being preprocessed
+    catalog = TileCatalog.from_directory(input_path, "*.png")
+    labels = fix_labels(
         f"{input_path}/labels.geojson",
-        f"{output_path}/corrected_labels.geojson",
+        f"{output_path}/corrected_labels.geojson" if keep_intermediate_files else None,
+        bbox=catalog.extent(epsg=4326) if len(catalog) else None,
     )
     if epsg == 3857:
-        reproject_labels_to_epsg3857(
-            f"{output_path}/corrected_labels.geojson",
-            f"{output_path}/labels_epsg3857.geojson",
+        labels = reproject_labels_to_epsg3857(
+            labels,
+            f"{output_path}/labels_epsg3857.geojson" if keep_intermediate_files else None,
+        )
+
+    parameters = {
+        "rasterize": rasterize,
+        "rasterize_options": sorted(rasterize_options or []) if rasterize else [],
+        "georeference_images": georeference_images,
+        "multimasks": multimasks,
+        "input_contact_spacing": input_contact_spacing,
+        "input_boundary_width": input_boundary_width,
+        "epsg": epsg,
+        "labels_format": labels_format,
+    }
+    tiles, manifest_tiles = catalog, {}
+    if incremental:
+        tiles, manifest_tiles = select_changed_tiles(output_path, catalog, labels, parameters, epsg)
+
+    if georeference_images:
+        if len(tiles) == len(catalog):
+            georeference_prediction_tiles(input_path, f"{output_path}/chips", crs=str(epsg), clip_bands_to=3)
+        elif len(tiles):
+            _georeference_tiles(tiles, output_path, epsg)
+        update_chip_index(
+            chip_index_path(output_path),
+            [os.path.join(output_path, "chips", f"{tile_id}.tif") for tile_id in tiles.tile_ids],
         )
 
     clip_labels(
@@ -98,19 +166,15 @@ def preprocess(
         output_path,
         rasterize,
         rasterize_options,
-        all_geojson_file=(
-            f"{output_path}/corrected_labels.geojson" if epsg == 4326 else f"{output_path}/labels_epsg3857.geojson"
-        ),
         epsg=epsg,
+        labels=labels,
+        tiles=tiles,
+        workers=workers,
+        rasterize_mode=rasterize_mode,
+        labels_format=labels_format,
     )
 
-    os.remove(f"{output_path}/corrected_labels.geojson")
-    if epsg == 3857:
-        os.remove(f"{output_path}/labels_epsg3857.geojson")
-
     if multimasks:
-        from .multimasks_from_polygons import multimasks_from_polygons
-
         assert os.path.isdir(f"{output_path}/chips"), "Chips do not exist. Set georeference_images=True."
         multimasks_from_polygons(
             f"{output_path}/labels",
@@ -118,4 +182,14 @@ def preprocess(
             f"{output_path}/multimasks",
             input_contact_spacing=input_contact_spacing,
             input_boundary_width=input_boundary_width,
+            label_store=label_store_path(output_path) if labels_format == "parquet" else None,
+            workers=workers,
+            chip_index=chip_index_path(output_path),
         )
+
+    if pack:
+        assert os.path.isdir(f"{output_path}/chips"), "Chips do not exist. Set georeference_images=True."
+        pack_preprocessed(output_path, workers=workers)
+
+    if incremental:
+        save_manifest(output_path, parameters, manifest_tiles)
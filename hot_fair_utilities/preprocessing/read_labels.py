@@ -0,0 +1,39 @@
+import os
+from functools import cache
+from importlib.util import find_spec
+
+import geopandas
+
+from .._logging import get_logger
+
+log = get_logger(__name__)
+
+
+@cache
+def _arrow_supported() -> bool:
+    """Whether GeoPandas can read through pyogrio's columnar Arrow API, logging once when it cannot."""
+    missing = [module for module in ("pyogrio", "pyarrow") if find_spec(module) is None]
+    if missing:
+        log.debug("%s not installed, reading labels with the default GeoPandas engine", " and ".join(missing))
+    return not missing
+
+
+def read_labels(path: str, bbox: tuple[float, float, float, float] | None = None) -> geopandas.GeoDataFrame:
+    """Read a label file into a GeoDataFrame.
+
+    Uses pyogrio in Arrow mode when pyogrio and pyarrow are installed, and
+    falls back to the default GeoPandas engine otherwise.
+
+    Args:
+        path: Path to the label file (e.g. GeoJSON).
+        bbox: Optional (minx, miny, maxx, maxy) in the CRS of the file. Only
+            features intersecting it are read, so peak memory scales with
+            the area of interest instead of the size of the file.
+    """
+    kwargs = {}
+    if bbox is not None:
+        kwargs["bbox"] = bbox
+    if _arrow_supported():
+        kwargs["engine"] = "pyogrio"
+        kwargs["use_arrow"] = True
+    return geopandas.read_file(os.path.relpath(path), **kwargs)
@@ -1,20 +1,27 @@
-# Third-party imports
-# Third party imports
-import os
-
 import geopandas
 
+from .read_labels import read_labels
+
 
-def reproject_labels_to_epsg3857(input_path: str, output_path: str) -> None:
+def reproject_labels_to_epsg3857(
+    input_path: str | geopandas.GeoDataFrame, output_path: str | None = None
+) -> geopandas.GeoDataFrame:
     """Convert a GeoJSON file with labels from EPSG:4326 to EPSG:3857.
 
     A new GeoJSON file is created, it contains coordinates in meters
     (easting, northing) in the 'WGS 84 / Pseudo-Mercator' projection.
 
     Args:
-        input_path: Path to the GeoJSON file where the input data are stored.
+        input_path: Path to the GeoJSON file where the input data are stored,
+            or the labels as an already loaded GeoDataFrame.
         output_path: Path to the GeoJSON file where the output data will go.
-    """
+            If None, the reprojected labels are only returned.
 
-    labels_gdf = geopandas.read_file(os.path.relpath(input_path), driver="GeoJSON").set_crs("EPSG:4326")
-    labels_gdf.to_crs("EPSG:3857").to_file(output_path, driver="GeoJSON")
+    Returns:
+        The reprojected labels.
+    """
+    labels_gdf = input_path if isinstance(input_path, geopandas.GeoDataFrame) else read_labels(input_path)
+    labels_gdf = labels_gdf.set_crs("EPSG:4326").to_crs("EPSG:3857")
+    if output_path is not None:
+        labels_gdf.to_file(output_path, driver="GeoJSON")
+    return labels_gdf
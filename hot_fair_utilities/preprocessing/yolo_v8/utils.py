@@ -1,12 +1,19 @@
 # Standard library imports
+import itertools
 import json
 import os
+import queue
+import shutil
+import threading
 
 # Third party imports
+import numpy as np
 import rasterio
 from PIL import Image
 from pyproj import Transformer
 
+from ...utils import link_file
+
 
 def get_geo_data(iwp):
     """
@@ -53,174 +60,361 @@ def get_geo_data(iwp):
         return results
 
 
-def check_and_clamp(values):
+def geo_data_from_bounds(left, bottom, right, top, crs="EPSG:4326"):
     """
-    Check and clamp the values in a nested list.
+    Builds the geo data of an EPSG:4326 chip from its bounds, without opening the chip.
+
+    The chip bounds of a TileCatalog equal those written by the georeferencing
+    step for EPSG:4326 chips, so the result matches get_geo_data for them.
 
     Parameters:
-    values (list): A nested list of values to be checked and clamped.
+    left, bottom, right, top (float): The bounds of the chip in EPSG:4326.
+    crs (str): The coordinate reference system of the chip.
 
     Returns:
-    list: A nested list of clamped values.
+    dict: The geo data, with the same keys as get_geo_data.
+    """
+    assert crs == "EPSG:4326", "Geo data can only be derived from bounds for EPSG:4326 chips"
+    return {
+        "left": left,
+        "right": right,
+        "top": top,
+        "bottom": bottom,
+        "width": right - left,
+        "height": top - bottom,
+        "crs": crs,
+    }
+
+
+def geo_data_from_metadata(metadata):
+    """
+    Builds the geo data of a chip from its chip index entry, without opening the chip.
+
+    Like get_geo_data, the bounds of chips not in EPSG:4326 are given in
+    (latitude, longitude) order.
 
+    Parameters:
+    metadata (dict): The chip metadata, as returned by chip_index.read_chip_metadata.
+
+    Returns:
+    dict: The geo data, with the same keys as get_geo_data.
+    """
+    west, south, east, north = metadata["bounds_4326"]
+    if metadata["crs"] == "EPSG:4326":
+        return geo_data_from_bounds(west, south, east, north)
+
+    return {
+        "left": south,
+        "right": north,
+        "top": east,
+        "bottom": west,
+        "width": north - south,
+        "height": east - west,
+        "crs": metadata["crs"],
+    }
+
+
+def round_coordinates(values, ndigits=6):
     """
-    # Initialize an empty list to store the clamped values
-    clamped_values = []
+    Rounds an array exactly like Python's round(value, ndigits) does for each value.
 
-    # Iterate over each sublist in the list
-    for sublist in values:
-        # Use a list comprehension to check and clamp each value in the sublist
-        clamped_sublist = [[max(0, min(1, value)) for value in pair] for pair in sublist]
+    np.round scales, rounds and scales back, which can round the other way
+    than the exact decimal value when the scaled value lies within an ulp
+    of a half. Those few values are rounded with round() instead.
 
-        # Add the processed sublist to the clamped_values list
-        clamped_values.append(clamped_sublist)
+    Parameters:
+    values (np.ndarray): The values to round.
+    ndigits (int, optional): The number of decimals (default is 6).
 
-    return clamped_values
+    Returns:
+    np.ndarray: The rounded values.
+    """
+    scaled = values * 10.0**ndigits
+    rounded = np.round(scaled) / 10.0**ndigits
+    ambiguous = np.abs(np.abs(scaled - np.trunc(scaled)) - 0.5) < 1e-6
+    for position in np.flatnonzero(ambiguous):
+        rounded.flat[position] = round(float(values.flat[position]), ndigits)
+    return rounded
 
 
-def flatten_list(nested_list):
+def format_coordinates(values):
     """
-    Flattens a nested list into a single flat list.
+    Formats normalized coordinates as space-separated YOLO label values.
+
+    Values clamped to the bounds of the chip are written as the integers 0
+    and 1, all others with the shortest representation of the float.
 
     Parameters:
-    nested_list (list): The nested list to be flattened.
+    values (np.ndarray): The normalized coordinates in [0, 1].
 
     Returns:
-    list: The flattened list.
+    str: The formatted coordinates.
     """
-    flat_list = []
-
-    # Iterate over all the elements in the given list
-    for item in nested_list:
-        # Check if the item is a list itself
-        if isinstance(item, list):
-            # If the item is a list, extend the flat list by adding elements of this item
-            flat_list.extend(flatten_list(item))
-        else:
-            # If the item is not a list, append the item itself
-            flat_list.append(item)
-    return flat_list
+    return " ".join("0" if value <= 0 else "1" if value >= 1 else repr(value) for value in values.ravel().tolist())
 
 
 def convert_coordinates(coordinates, geo_dict):
     """
-    Convert coordinates from one coordinate system to another based on the provided geo_dict.
+    Convert the rings of a polygon to coordinates normalized to the chip, based on the provided geo_dict.
+
+    All vertices of all rings are converted at once as an array. Values
+    are rounded to 6 decimals and clamped to [0, 1].
 
     Args:
-        coordinates (list): A list of coordinate sets.
+        coordinates (list): The rings of a GeoJSON polygon.
         geo_dict (dict): A dictionary containing information about the coordinate system.
 
     Returns:
-        list: The converted coordinates.
+        np.ndarray: The converted (x, y) coordinates of all vertices, with shape (N, 2).
 
     Raises:
         AssertionError: If coordinates are outside the [0, 1] range.
     """
-    # Iterate over the outer list
-    for i in range(len(coordinates)):
-        # Iterate over each coordinate set in the inner list
-        for j in range(len(coordinates[i])):
-            if geo_dict["crs"] == "EPSG:4326":
-                # Convert the coordinates for the EPSG:4326
-                coordinates[i][j] = [
-                    round((coordinates[i][j][0] - geo_dict["left"]) / geo_dict["width"], 6),
-                    round((geo_dict["top"] - coordinates[i][j][1]) / geo_dict["height"], 6),
-                ]
-            else:
-                # Convert the coordinates for not EPSG:4326
-                coordinates[i][j] = [
-                    round(
-                        (coordinates[i][j][0] - geo_dict["bottom"]) / geo_dict["height"],
-                        6,
-                    ),
-                    round(
-                        (geo_dict["right"] - coordinates[i][j][1]) / geo_dict["width"],
-                        6,
-                    ),
-                ]
-
-    coordinates = check_and_clamp(coordinates)
+    vertices = np.concatenate([np.asarray(ring, dtype=np.float64)[:, :2] for ring in coordinates])
+
+    if geo_dict["crs"] == "EPSG:4326":
+        # Convert the coordinates for the EPSG:4326
+        x = (vertices[:, 0] - geo_dict["left"]) / geo_dict["width"]
+        y = (geo_dict["top"] - vertices[:, 1]) / geo_dict["height"]
+    else:
+        # Convert the coordinates for not EPSG:4326
+        x = (vertices[:, 0] - geo_dict["bottom"]) / geo_dict["height"]
+        y = (geo_dict["right"] - vertices[:, 1]) / geo_dict["width"]
+
+    converted = np.clip(round_coordinates(np.column_stack([x, y])), 0, 1)
 
     # Make sure that the coordinates are within the expected range
-    assert max(flatten_list(coordinates)) <= 1, "The maximum coordinate value is greater than 1"
-    assert min(flatten_list(coordinates)) >= 0, "The minimum coordinate value is less than 0"
+    assert converted.max() <= 1, "The maximum coordinate value is greater than 1"
+    assert converted.min() >= 0, "The minimum coordinate value is less than 0"
+
+    return converted
+
+
+class LabelWriter:
+    """
+    Writes label files on a background thread, so converting labels never waits on the disk.
 
-    return coordinates
+    Files are queued with write() and written in batches of whatever is
+    queued, grouped by directory. Each directory is created once. The queue
+    is bounded, so conversion pauses if the disk falls far behind.
 
+    Example::
 
-def write_yolo_file(iwp, folder, output_path, class_index=0):
+        with LabelWriter() as writer:
+            write_yolo_file(cwp, "train", output_path, writer=writer)
+    """
+
+    def __init__(self, max_pending=1024):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._directories = set()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="label-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, path, content):
+        """Queue the content of a file to be written."""
+        if self._error is not None:
+            raise self._error
+        self._queue.put((path, content))
+
+    def close(self):
+        """Write all queued files and stop the thread. Raises the first error of a write."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except Exception:
+            # An error raised in the with block takes precedence over one of the writes
+            if exc_type is None:
+                raise
+
+    def _run(self):
+        closed = False
+        while not closed:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            closed = None in batch
+            batch = sorted((item for item in batch if item is not None), key=lambda item: item[0])
+            if self._error is None:
+                try:
+                    self._write_batch(batch)
+                except Exception as error:
+                    self._error = error
+
+    def _write_batch(self, batch):
+        for directory, files in itertools.groupby(batch, key=lambda item: os.path.dirname(item[0])):
+            if directory not in self._directories:
+                os.makedirs(directory, exist_ok=True)
+                self._directories.add(directory)
+            for path, content in files:
+                with open(path, "w") as file:
+                    file.write(content)
+
+
+def yolo_label_path(iwp, folder, output_path):
+    """
+    Returns the path of the YOLO label file of a chip.
+
+    Args:
+        iwp (str): The image with path.
+        folder (str): The folder name (train, val, or test).
+        output_path (str): The path to the output YOLO data folders.
+
+    Returns:
+        str: The label file with path.
+    """
+    return os.path.join(output_path, "labels", folder, os.path.basename(iwp).replace(".tif", ".txt"))
+
+
+def polygon_rings(polygon):
+    """
+    Returns the exterior and interior rings of a shapely polygon as coordinate arrays.
+
+    The rings are in the order of the GeoJSON "coordinates" of the polygon.
+
+    Parameters:
+    polygon (shapely.Polygon): The polygon.
+
+    Returns:
+    list: The (N, 2) coordinate array of each ring.
+    """
+    return [np.asarray(polygon.exterior.coords), *(np.asarray(ring.coords) for ring in polygon.interiors)]
+
+
+def yolo_label_content(iwp, class_index=0, geo_dict=None, features=None, geometries=None):
+    """
+    Builds the content of the YOLO label file of a chip.
+
+    Args:
+        iwp (str): The image with path.
+        class_index (int, optional): The class index for the YOLO label. Defaults to 0.
+        geo_dict (dict, optional): The geo data of the chip. Read from the chip if not given.
+        features (list, optional): The GeoJSON features of the chip's labels. Read from the
+            chip's GeoJSON label file if neither features nor geometries are given.
+        geometries (list or GeoSeries, optional): The chip's labels as shapely geometries in EPSG:4326,
+            e.g. clipped from the global labels. Used instead of GeoJSON features.
+
+    Returns:
+        str: One line per polygon, without a trailing new line. Empty for chips
+        without polygons.
+    """
+    # Get the GeoJSON filename with path from the chip filename with path
+    lwp = iwp.replace(".tif", ".geojson").replace("chips", "labels")
+
+    # Fetch the chip's Exif data
+    if geo_dict is None:
+        geo_dict = get_geo_data(iwp)
+
+    if geometries is not None:
+        polygons = [
+            polygon_rings(geometry)
+            for geometry in geometries
+            if geometry.geom_type == "Polygon" and not geometry.is_empty
+        ]
+    else:
+        # Open the GeoJSON file
+        if features is None:
+            with open(lwp) as file:
+                features = json.load(file)["features"]
+        polygons = [
+            feature["geometry"]["coordinates"] for feature in features if feature["geometry"]["type"] == "Polygon"
+        ]
+
+    lines = [f"{class_index} " + format_coordinates(convert_coordinates(rings, geo_dict)) for rings in polygons]
+    return "\n".join(lines)
+
+
+def write_yolo_file(iwp, folder, output_path, class_index=0, geo_dict=None, features=None, writer=None):
     """
     Writes YOLO label file based on the given image with path and class index.
 
+    The label file is built in memory and written at once. Kept as public
+    API for converting single chips; yolo_format builds the labels of all
+    chips with yolo_label_content.
+
     Args:
         iwp (str): The image with path.
         output_path(path) : output path for the yolo label file
         class_index (int, optional): The class index for the YOLO label. Defaults to 0.
+        geo_dict (dict, optional): The geo data of the chip. Read from the chip if not given.
+        features (list, optional): The GeoJSON features of the chip's labels. Read from the
+            chip's GeoJSON label file if not given.
+        writer (LabelWriter, optional): Writer to queue the label file to. Written
+            directly if not given.
 
     Returns:
         None
     """
+    ywp = yolo_label_path(iwp, folder, output_path)
+    content = yolo_label_content(iwp, class_index=class_index, geo_dict=geo_dict, features=features)
 
-    # Get the GeoJSON filename with path from the chip filename with path
-    lwp = iwp.replace(".tif", ".geojson").replace("chips", "labels")
+    if writer is not None:
+        writer.write(ywp, content)
+        return
 
-    # Create the YOLO label filename with path from the chip filename with path
-    ywp = os.path.join(output_path, "labels", folder, os.path.basename(iwp).replace(".tif", ".txt"))
     # Create the YOLO label folder if it does not exist
     os.makedirs(os.path.dirname(ywp), exist_ok=True)
+    with open(ywp, "w") as file:
+        file.write(content)
 
-    # Remove the YOLO label file if it already exists
-    if os.path.exists(ywp):
-        os.remove(ywp)
 
-    # Fetch the chip's Exif data
-    geo_dict = get_geo_data(iwp)
+IMAGE_MODES = ("link", "copy", "encode")
 
-    # Open the GeoJSON file
-    with open(lwp) as file:
-        data = json.load(file)
+# Codecs of the "encode" image mode, as (file extension, PIL format)
+IMAGE_CODECS = {"jpg": ("jpg", "JPEG"), "png": ("png", "PNG"), "webp": ("webp", "WEBP")}
 
-    # Initialize the polygon count
-    polygon_count = 0
 
-    # Navigate through the GeoJSON structure
-    for feature in data["features"]:
-        if feature["geometry"]["type"] == "Polygon":
-            # Increment the polygon count
-            polygon_count += 1
+def encode_image(cwp, folder, output_path, codec="jpg", quality_level=100):
+    """
+    Re-encodes a TIFF image file as an RGB image with the given codec.
 
-            # Get the coordinates of the polygon
-            coordinates = feature["geometry"]["coordinates"]
+    Parameters:
+    cwp (str): The path to the TIFF image file.
+    folder (str): The folder name (train, val, or test).
+    output_path (str): The path to the output YOLO data folders.
+    codec (str, optional): One of IMAGE_CODECS (default is "jpg").
+    quality_level (int, optional): The quality level of lossy codecs (default is 100).
 
-            # Convert the coordinates
-            new_coordinates = flatten_list(convert_coordinates(coordinates, geo_dict))
-            new_coordinate_str = " ".join(map(str, flatten_list(new_coordinates)))
+    Returns:
+    str: The output path of the image file.
+    """
+    assert codec in IMAGE_CODECS, f"codec must be one of {tuple(IMAGE_CODECS)}"
+    extension, image_format = IMAGE_CODECS[codec]
+
+    # Open the tif image file
+    with Image.open(cwp) as img:
+        # Convert the image to RGB
+        rgb_img = img.convert("RGB")
 
-            # Write the converted coordinates to a file
-            with open(ywp, "a+") as file:
-                # Move the file pointer to the start of the file to check its contents.
-                file.seek(0)  # Go to the beginning of the file
-                first_character = file.read(1)  # Read the first character to determine if the file is empty
+        # Define the output path with the codec's extension
+        iwp = os.path.join(output_path, "images", folder, os.path.basename(cwp).replace(".tif", f".{extension}"))
 
-                # If the first character does not exist, the file is empty
-                if not first_character:
-                    # Write the first string without a new line before it
-                    file.write(f"{class_index} " + new_coordinate_str)
+        # Create the output folder if it does not exist
+        os.makedirs(os.path.dirname(iwp), exist_ok=True)
 
-                else:
-                    # The file is not empty, write the new string on a new line
-                    file.write(f"\n{class_index} " + new_coordinate_str)
+        # Save the image at quality level ql
+        rgb_img.save(iwp, image_format, quality=quality_level)
 
-    if polygon_count == 0:
-        # Open the file in write mode, which creates a new file if it doesn't exist
-        with open(ywp, "w") as file:
-            pass  # No need to write anything, just creating the file
+        return iwp
 
 
 def convert_tif_to_jpg(cwp, folder, output_path, quality_level=100):
     """
     Converts a TIFF image file to JPEG format.
 
+    Kept as public API; yolo_format places the images with stage_image.
+
     Parameters:
     cwp (str): The path to the TIFF image file.
     folder (str): The folder name (train, val, or test).
@@ -230,22 +424,39 @@ def convert_tif_to_jpg(cwp, folder, output_path, quality_level=100):
     Returns:
     str: The output path of the JPEG image file.
     """
-    # Open the tif image file
-    with Image.open(cwp) as img:
-        # Convert the image to RGB and save it as a JPEG
-        rgb_img = img.convert("RGB")
+    return f"Writing: {encode_image(cwp, folder, output_path, codec='jpg', quality_level=quality_level)}"
 
-        # Define the output path with .jpg extension
-        jwp = os.path.join(
-            os.path.join(output_path, "images", folder),
-            cwp.split("/")[-1].replace(".tif", ".jpg"),
-        )
 
-        # Create the output folder if it does not exist
-        os.makedirs(os.path.dirname(jwp), exist_ok=True)
+def stage_image(cwp, folder, output_path, image_mode="link", codec="jpg", quality_level=100):
+    """
+    Places a chip in the images folder of a YOLO dataset.
 
-        # Save the image at quality level ql
-        rgb_img.save(jwp, "JPEG", quality=quality_level)
+    Parameters:
+    cwp (str): The path to the TIFF image file.
+    folder (str): The folder name (train, val, or test).
+    output_path (str): The path to the output YOLO data folders.
+    image_mode (str, optional): "link" to hardlink the chip, or symlink it where
+        hardlinks are not possible (e.g. across filesystems), "copy" to copy it,
+        or "encode" to re-encode it with encode_image (default is "link").
+    codec (str, optional): The codec of the "encode" mode (default is "jpg").
+    quality_level (int, optional): The quality level of the "encode" mode (default is 100).
 
-        # Print the output path
-        return f"Writing: {jwp}"
+    Returns:
+    str: The output path of the image file.
+    """
+    assert image_mode in IMAGE_MODES, f"image_mode must be one of {IMAGE_MODES}"
+    if image_mode == "encode":
+        return encode_image(cwp, folder, output_path, codec=codec, quality_level=quality_level)
+
+    iwp = os.path.join(output_path, "images", folder, os.path.basename(cwp))
+    os.makedirs(os.path.dirname(iwp), exist_ok=True)
+
+    if image_mode == "copy":
+        shutil.copyfile(cwp, iwp)
+        return iwp
+
+    # A link left by an interrupted run would make os.link fail
+    if os.path.lexists(iwp):
+        os.remove(iwp)
+    link_file(cwp, iwp)
+    return iwp
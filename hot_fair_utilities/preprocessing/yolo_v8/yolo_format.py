@@ -1,16 +1,40 @@
 # Standard library imports
 import glob
+import hashlib
+import json
 import os
 import shutil
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from pathlib import Path
 
 import numpy as np
+import rasterio
 import yaml
 
 from ..._logging import get_logger, track
-from .utils import convert_tif_to_jpg, write_yolo_file
+from ...tile_catalog import TileCatalog
+from ..chip_index import chip_index_path, chip_metadata
+from ..clip_labels import _clip_to_bounds
+from ..fix_labels import fix_labels
+from ..label_store import LABEL_STORE_FILENAME, read_label_store
+from ..manifest import load_manifest, save_manifest
+from .utils import (
+    IMAGE_CODECS,
+    IMAGE_MODES,
+    LabelWriter,
+    geo_data_from_bounds,
+    geo_data_from_metadata,
+    stage_image,
+    yolo_label_content,
+    yolo_label_path,
+)
 
 log = get_logger(__name__)
 
+YOLO_MANIFEST_FILENAME = "yolo_manifest.json"
+
 
 def yolo_format(
     input_path="preprocessed/*",
@@ -19,74 +43,142 @@ def yolo_format(
     train_split=0.7,
     val_split=0.15,
     test_split=0.15,
+    workers=1,
+    image_mode="link",
+    image_codec="jpg",
+    image_quality=100,
+    labels=None,
 ):
     """
     Preprocess data for YOLO model training.
 
+    Each tile is assigned to a split by a hash of its tile id (see tile_split),
+    and no split with a non-zero fraction is left empty (see assign_splits).
+    The dataset is updated incrementally: a manifest in output_path records
+    the split, chip and labels of every converted chip, so a rerun only
+    converts new or changed chips and removes the outputs of deleted ones.
+    Changing the image settings rebuilds the dataset.
+
     Args:
         input_path (str, optional): The path to the input data folders. Defaults to "preprocessed/*".
         output_path (str, optional): The path to the output YOLO data folders. Defaults to "ramp_data_yolo".
-        seed (int, optional): The random seed for data splitting. Defaults to 42.
+        seed (int, optional): The seed of the hash that assigns tiles to splits. Defaults to 42.
         train_split (float, optional): The percentage of data to be used for training. Defaults to 0.7.
         val_split (float, optional): The percentage of data to be used for validation. Defaults to 0.15.
         test_split (float, optional): The percentage of data to be used for testing. Defaults to 0.15.
+        workers (int, optional): Number of processes converting the chips. Defaults to 1.
+        image_mode (str, optional): How the chips are placed in the images folders: "link" to
+            hardlink them (or symlink them across filesystems), "copy" to copy the GeoTIFFs, or
+            "encode" to re-encode them with image_codec. Ultralytics reads the GeoTIFF chips
+            directly. Defaults to "link".
+        image_codec (str, optional): Codec of the "encode" mode: "jpg", "png" or "webp". Defaults to "jpg".
+        image_quality (int, optional): Quality of the "encode" mode for lossy codecs. Defaults to 100.
+        labels (GeoDataFrame or str, optional): The global labels, or the path of a labels GeoJSON
+            file to fix with fix_labels. When given, the label of each chip is built from these
+            labels clipped to the chip's bounds, and the per-tile label files of the input folders
+            are neither read nor required. Unlike the per-tile label files, which hold the labels
+            in the CRS of the preprocess and are only converted correctly for EPSG:4326 chips,
+            the global labels give correct YOLO labels for chips in any CRS. Defaults to None.
 
     Returns:
         None
     """
     # Verify the sum of the splits
     assert train_split + val_split + test_split == 1, "The sum of the splits must be equal to 1"
+    assert workers >= 1, "workers must be at least 1"
+    assert image_mode in IMAGE_MODES, f"image_mode must be one of {IMAGE_MODES}"
+    assert image_codec in IMAGE_CODECS, f"image_codec must be one of {tuple(IMAGE_CODECS)}"
 
     log.info("Train-val-test split: %s-%s-%s", train_split, val_split, test_split)
 
-    # Set the random seed
-    np.random.seed(seed)
-
     # Find the files
-    cwps, _lwps, _base_folders = find_files(input_path)
-
-    # Shuffle indices
-    shuffled_indices = np.random.permutation(len(cwps))
-
-    # Calculate split indices
-    train_end = int(len(cwps) * train_split)
-    val_end = train_end + int(len(cwps) * val_split)
-
-    # Split the indices into training, validation, and testing
-    train_indices = shuffled_indices[:train_end]
-    val_indices = shuffled_indices[train_end:val_end]
-    test_indices = shuffled_indices[val_end:]
-
-    # Create train, val, and test arrays
-    train_cwps = [cwps[i] for i in train_indices]
-    val_cwps = [cwps[i] for i in val_indices]
-    test_cwps = [cwps[i] for i in test_indices]
-
-    log.info("Train: %d, Validation: %d, Test: %d", len(train_cwps), len(val_cwps), len(test_cwps))
-
-    # Check if the YOLO folder exists, if not create labels, images, and folders
-    if os.path.exists(output_path):
-        shutil.rmtree(output_path, ignore_errors=True)
+    if labels is None:
+        cwps, _lwps, _base_folders = find_files(input_path)
+    else:
+        cwps = find_chips(input_path)
+
+    # Each tile keeps its split when chips are added or removed
+    splits = assign_splits(
+        [os.path.basename(cwp).replace(".tif", "") for cwp in cwps], seed, train_split, val_split, test_split
+    )
+
+    log.info("Train: %d, Validation: %d, Test: %d", splits.count("train"), splits.count("val"), splits.count("test"))
+
+    # Rebuild the dataset if it was written with other image settings, or
+    # without a manifest
+    parameters = {"image_mode": image_mode, "image_codec": image_codec, "image_quality": image_quality}
+    previous = load_manifest(output_path, YOLO_MANIFEST_FILENAME)
+    if previous["parameters"] != parameters:
+        if os.path.exists(output_path):
+            shutil.rmtree(output_path, ignore_errors=True)
+        previous = {"parameters": None, "tiles": {}}
 
     os.makedirs(output_path, exist_ok=True)
 
-    for train_cwp in track(train_cwps, description="Generating training labels"):
-        write_yolo_file(train_cwp, "train", output_path)
-
-    for val_cwp in track(val_cwps, description="Generating validation labels"):
-        write_yolo_file(val_cwp, "val", output_path)
-
-    for test_cwp in track(test_cwps, description="Generating test labels"):
-        write_yolo_file(test_cwp, "test", output_path)
-
-    for train_cwp in track(train_cwps, description="Generating training images"):
-        convert_tif_to_jpg(train_cwp, "train", output_path)
-
-    for val_cwp in track(val_cwps, description="Generating validation images"):
-        convert_tif_to_jpg(val_cwp, "val", output_path)
+    if labels is None:
+        features = store_features(cwps, _lwps)
+        geometries = {}
+        label_signatures = [_label_signature(lwp, features.get(cwp)) for cwp, lwp in zip(cwps, _lwps, strict=True)]
+    else:
+        features = {}
+        metadata = _folder_chip_metadata(cwps)
+        geometries = clip_chip_labels(labels, {cwp: metadata[cwp]["bounds_4326"] for cwp in cwps})
+        label_signatures = [hashlib.sha256(b"".join(geometries[cwp].to_wkb())).hexdigest() for cwp in cwps]
+    chips = {
+        cwp: {"split": split, "chip": _file_signature(cwp), "labels": label_signature}
+        for cwp, split, label_signature in zip(cwps, splits, label_signatures, strict=True)
+    }
 
-    for test_cwp in track(test_cwps, description="Generating test images"):
-        convert_tif_to_jpg(test_cwp, "test", output_path)
+    # Remove the outputs of deleted chips and of chips to convert again
+    removed = set(previous["tiles"]) - set(chips)
+    pending = [cwp for cwp in cwps if _chip_state(previous["tiles"].get(cwp)) != chips[cwp]]
+    for cwp in removed | (set(pending) & set(previous["tiles"])):
+        for output in ("image", "label"):
+            Path(output_path, previous["tiles"][cwp][output]).unlink(missing_ok=True)
+    log.info("%d of %d chips changed, %d removed", len(pending), len(cwps), len(removed))
+
+    if labels is None:
+        geo_data = chip_geo_data(pending)
+    else:
+        geo_data = {cwp: geo_data_from_metadata(metadata[cwp]) for cwp in pending}
+
+    # Each chip is converted to its image and label in one pass. Label
+    # files are written on a background thread of this process.
+    convert = partial(
+        _convert_chip,
+        output_path=output_path,
+        image_mode=image_mode,
+        image_codec=image_codec,
+        image_quality=image_quality,
+    )
+    folders = [chips[cwp]["split"] for cwp in pending]
+    geo_dicts = [geo_data.get(cwp) for cwp in pending]
+    chip_features = [features.get(cwp) for cwp in pending]
+    chip_geometries = [geometries.get(cwp) for cwp in pending]
+    description = "Generating images and labels"
+    unchanged = set(previous["tiles"]) - removed - set(pending)
+    manifest_chips = {cwp: previous["tiles"][cwp] for cwp in unchanged}
+
+    with ExitStack() as stack:
+        if workers == 1:
+            results = map(convert, pending, folders, geo_dicts, chip_features, chip_geometries)
+        else:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            chunksize = max(1, len(pending) // (workers * 4))
+            results = executor.map(
+                convert, pending, folders, geo_dicts, chip_features, chip_geometries, chunksize=chunksize
+            )
+        # executor.map has started the workers, so they are never forked
+        # while the label writer thread runs
+        writer = stack.enter_context(LabelWriter())
+
+        for cwp, (iwp, ywp, content) in zip(
+            pending, track(results, description=description, total=len(pending)), strict=True
+        ):
+            writer.write(ywp, content)
+            manifest_chips[cwp] = _chip_entry(chips[cwp], iwp, ywp, output_path)
+
+    save_manifest(output_path, parameters, manifest_chips, YOLO_MANIFEST_FILENAME)
 
     attr = {
         "path": output_path,
@@ -102,16 +194,259 @@ def yolo_format(
         yaml.dump(attr, f)
 
 
+def _convert_chip(cwp, folder, geo_dict, features, geometries, output_path, image_mode, image_codec, image_quality):
+    """
+    Stage a chip as a YOLO image and build its YOLO label.
+
+    Returns:
+        tuple: The path of the chip's image, and the path and content of its label file.
+    """
+    iwp = stage_image(cwp, folder, output_path, image_mode=image_mode, codec=image_codec, quality_level=image_quality)
+    ywp = yolo_label_path(cwp, folder, output_path)
+    return iwp, ywp, yolo_label_content(cwp, geo_dict=geo_dict, features=features, geometries=geometries)
+
+
+def _tile_fraction(tile_id, seed):
+    """Return the position of a tile in [0, 1), from a hash of its id salted with seed."""
+    digest = hashlib.sha256(f"{seed}:{tile_id}".encode()).digest()
+    return int.from_bytes(digest[:8], "big") / 2**64
+
+
+def tile_split(tile_id, seed=42, train_split=0.7, val_split=0.15):
+    """
+    Assign a tile to the train, val or test split from a hash of its id.
+
+    The split of a tile only depends on its id, the seed and the split
+    fractions, so adding or removing tiles never moves other tiles.
+
+    Args:
+        tile_id (str): The tile id, e.g. "OAM-x-y-z".
+        seed (int, optional): Salt of the hash. Defaults to 42.
+        train_split (float, optional): The fraction of tiles in the train split. Defaults to 0.7.
+        val_split (float, optional): The fraction of tiles in the val split. Defaults to 0.15.
+
+    Returns:
+        str: "train", "val" or "test".
+    """
+    fraction = _tile_fraction(tile_id, seed)
+    if fraction < train_split:
+        return "train"
+    if fraction < train_split + val_split:
+        return "val"
+    return "test"
+
+
+def assign_splits(tile_ids, seed=42, train_split=0.7, val_split=0.15, test_split=0.15):
+    """
+    Assign tiles to splits with tile_split, leaving no split with a non-zero fraction empty.
+
+    On small datasets the hash can leave a split empty, which YOLO training
+    does not accept. Each empty split then takes the tile of a split with
+    more than one tile whose hash is closest to its range, so the other
+    tiles keep their split.
+
+    Args:
+        tile_ids (list): The tile ids.
+        seed (int, optional): Salt of the hash. Defaults to 42.
+        train_split (float, optional): The fraction of tiles in the train split. Defaults to 0.7.
+        val_split (float, optional): The fraction of tiles in the val split. Defaults to 0.15.
+        test_split (float, optional): The fraction of tiles in the test split. Defaults to 0.15.
+
+    Returns:
+        list: The split of each tile, "train", "val" or "test".
+
+    Raises:
+        ValueError: If there are fewer tiles than splits with a non-zero fraction.
+    """
+    ranges = {
+        "train": (0, train_split),
+        "val": (train_split, train_split + val_split),
+        "test": (train_split + val_split, 1),
+    }
+    required = [split for split, (low, high) in ranges.items() if high > low]
+    if len(tile_ids) < len(required):
+        raise ValueError(f"{len(tile_ids)} chips cannot fill the {len(required)} splits {', '.join(required)}")
+
+    fractions = [_tile_fraction(tile_id, seed) for tile_id in tile_ids]
+    splits = [tile_split(tile_id, seed, train_split, val_split) for tile_id in tile_ids]
+    for split in required:
+        if split in splits:
+            continue
+        low, high = ranges[split]
+        movable = [position for position, other in enumerate(splits) if other in required and splits.count(other) > 1]
+        position = min(movable, key=lambda position: max(low - fractions[position], fractions[position] - high))
+        log.warning("The %s split is empty, moving %s to it from %s", split, tile_ids[position], splits[position])
+        splits[position] = split
+    return splits
+
+
+def _file_signature(path):
+    """Return the size and modification time of a file, to detect changes without reading it."""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _label_signature(lwp, features):
+    """Return the signature of a chip's labels: of its GeoJSON file, or a digest of its label store features."""
+    if features is None:
+        return _file_signature(lwp)
+    return hashlib.sha256(json.dumps(features, sort_keys=True).encode()).hexdigest()
+
+
+def _chip_state(entry):
+    """Return the part of a manifest entry that decides whether a chip has to be converted again."""
+    if entry is None:
+        return None
+    return {"split": entry["split"], "chip": entry["chip"], "labels": entry["labels"]}
+
+
+def _chip_entry(state, iwp, ywp, output_path):
+    """Return the manifest entry of a converted chip, with its outputs relative to output_path."""
+    return {**state, "image": os.path.relpath(iwp, output_path), "label": os.path.relpath(ywp, output_path)}
+
+
+def _folder_chip_metadata(cwps):
+    """Return the chip metadata of chips, read from the chip index of their preprocessed folder if it has one."""
+    folders = {}
+    for cwp in cwps:
+        folders.setdefault(os.path.dirname(cwp), []).append(cwp)
+
+    metadata = {}
+    for folder, folder_cwps in folders.items():
+        index_path = chip_index_path(os.path.dirname(folder))
+        index_path = index_path if os.path.isfile(index_path) else None
+        metadata.update(zip(folder_cwps, chip_metadata(folder_cwps, index_path), strict=True))
+    return metadata
+
+
+def clip_chip_labels(labels, chip_bounds):
+    """
+    Clip the global labels to the bounds of each chip.
+
+    Each chip is clipped against the spatial index of the labels, so no
+    per-tile label file is written or read.
+
+    Args:
+        labels (GeoDataFrame or str): The global labels, or the path of a labels
+            GeoJSON file, which is read and fixed within the extent of the chips.
+        chip_bounds (dict): The (left, bottom, right, top) bounds in EPSG:4326
+            by chip filename with path.
+
+    Returns:
+        dict: The clipped label geometries in EPSG:4326, as a GeoSeries, by chip filename with path.
+    """
+    if isinstance(labels, str):
+        extent = np.array(list(chip_bounds.values()), dtype=np.float64).reshape(-1, 4)
+        bbox = (*extent[:, :2].min(axis=0), *extent[:, 2:].max(axis=0)) if len(extent) else None
+        labels = fix_labels(labels, bbox=bbox)
+    if labels.crs is not None and labels.crs.to_epsg() != 4326:
+        labels = labels.to_crs(epsg=4326)
+
+    return {
+        cwp: _clip_to_bounds(labels, tuple(bounds)).geometry
+        for cwp, bounds in track(chip_bounds.items(), description="Clipping labels", total=len(chip_bounds))
+    }
+
+
+def find_chips(data_folders):
+    """
+    Find the chip (.tif) files in the specified folders.
+
+    Args:
+        data_folders (str): The path to the input data folders.
+
+    Returns:
+        list: Sorted list of chip filenames with path.
+    """
+    return sorted(cwp for folder in glob.glob(data_folders) for cwp in glob.glob(f"{folder}/chips/*.tif"))
+
+
+def chip_geo_data(cwps):
+    """
+    Derive the geo data of chips without opening each of them.
+
+    Chips of a folder preprocessed with a chip index get their geo data
+    from the index. Otherwise only the first chip of each chips folder is
+    opened, to read the folder's CRS, and the geo data of EPSG:4326 chips
+    is derived from their tile filenames. Remaining chips are left out, and
+    yolo_label_content reads their geo data from the chip itself.
+
+    Args:
+        cwps (list): List of chip filenames with path.
+
+    Returns:
+        dict: Geo data by chip filename with path.
+    """
+    folders = {}
+    for cwp in cwps:
+        folders.setdefault(os.path.dirname(cwp), []).append(cwp)
+
+    geo_data = {}
+    for folder, folder_cwps in folders.items():
+        index_path = chip_index_path(os.path.dirname(folder))
+        if os.path.isfile(index_path):
+            for cwp, metadata in zip(folder_cwps, chip_metadata(folder_cwps, index_path), strict=True):
+                geo_data[cwp] = geo_data_from_metadata(metadata)
+            continue
+
+        with rasterio.open(folder_cwps[0]) as src:
+            crs = src.crs.to_string() if src.crs else None
+        if crs != "EPSG:4326":
+            continue
+
+        catalog = TileCatalog.from_paths(folder_cwps)
+        for cwp, bounds in zip(catalog.paths, catalog.bounds(epsg=4326).tolist(), strict=True):
+            geo_data[cwp] = geo_data_from_bounds(*bounds, crs=crs)
+
+    return geo_data
+
+
+def store_features(cwps, lwps):
+    """
+    Read the GeoJSON features of chips whose labels are in a label store.
+
+    Each label store is read once, filtered to the tiles of its chips.
+
+    Args:
+        cwps (list): List of chip filenames with path.
+        lwps (list): List of label filenames with path, as returned by find_files.
+
+    Returns:
+        dict: GeoJSON features by chip filename with path. Chips with GeoJSON
+        label files are left out.
+    """
+    stores = {}
+    for cwp, lwp in zip(cwps, lwps, strict=True):
+        if os.path.basename(lwp) == LABEL_STORE_FILENAME:
+            stores.setdefault(lwp, []).append(cwp)
+
+    features = {}
+    for store, store_cwps in stores.items():
+        tile_ids = [os.path.basename(cwp).replace(".tif", "") for cwp in store_cwps]
+        labels = read_label_store(store, tile_ids)
+        tile_features = {
+            tile_id: json.loads(tile_labels.drop(columns="tile_id").to_json())["features"]
+            for tile_id, tile_labels in labels.groupby("tile_id")
+        }
+        for cwp, tile_id in zip(store_cwps, tile_ids, strict=True):
+            features[cwp] = tile_features.get(tile_id, [])
+
+    return features
+
+
 def find_files(data_folders):
     """
     Find chip (.tif) and label (.geojson) files in the specified folders.
 
+    Folders whose labels were written to a label store instead of per-tile
+    GeoJSON files get the path of the store as the label file of each chip.
+
     Args:
         data_folders (str): The path to the input data folders.
 
     Returns:
         cwps (list): List of chip filenames with path.
-        lwps (list): List of label filenames with path.
+        lwps (list): List of label filenames (or label store) with path.
         base_folders (list): List of base folder names.
     """
     # Find the folders
@@ -124,6 +459,9 @@ def find_files(data_folders):
     # Create a list to store the base folder names
     base_folders = []
 
+    # Label store of the label files that were not written separately
+    store_labels = {}
+
     for folder in data_folders:
         # Pattern to match all .tif files in the current folder, including subdirectories
         tif_pattern = f"{folder}/chips/*.tif"
@@ -142,6 +480,15 @@ def find_files(data_folders):
         # Find all .geojson files
         found_geojson_files = glob.glob(geojson_pattern, recursive=True)
 
+        # Use the label store if the labels were not written as separate files
+        label_store = os.path.join(folder, LABEL_STORE_FILENAME)
+        if not found_geojson_files and os.path.isfile(label_store):
+            found_geojson_files = [
+                os.path.join(folder, "labels", os.path.basename(file).replace(".tif", ".geojson"))
+                for file in found_tif_files
+            ]
+            store_labels.update({file: label_store for file in found_geojson_files})
+
         # Add found .geojson files to the geojson_files list
         lwps.extend(found_geojson_files)
 
@@ -161,4 +508,6 @@ def find_files(data_folders):
 
         base_folders.append(cwp.split("/")[1])
 
+    lwps = [store_labels.get(lwp, lwp) for lwp in lwps]
+
     return cwps, lwps, base_folders
@@ -0,0 +1,123 @@
+import math
+import os
+from dataclasses import dataclass, field
+from glob import glob
+
+import numpy as np
+
+# Circumference of the Web Mercator sphere in meters, as used by mercantile
+CE = 2 * math.pi * 6378137.0
+
+
+def tile_id_from_filename(filename: str) -> str:
+    """Return the tile id of a tile file, e.g. "OAM-x-y-z" for "OAM-x-y-z.mask.tif"."""
+    return os.path.basename(filename).split(".", 1)[0]
+
+
+def xyz_from_filename(filename: str) -> tuple[int, int, int]:
+    """Extract the x, y and zoom of an OAM-style "<prefix>-<x>-<y>-<z>" filename."""
+    parts = tile_id_from_filename(filename).split("-")
+    if len(parts) < 3:
+        raise ValueError(f"Could not extract tile coordinates from {filename}")
+    x_tile, y_tile, zoom = map(int, parts[-3:])
+    return x_tile, y_tile, zoom
+
+
+def _latitudes(y: np.ndarray, z: np.ndarray) -> np.ndarray:
+    """Return the latitude of the top edge of tile rows y at zoom z.
+
+    The transcendental functions go through ``math`` once per distinct row,
+    since NumPy's ``sinh``/``arctan`` can differ from mercantile in the last
+    bit.
+    """
+    rows, inverse = np.unique(np.column_stack([y, z]), axis=0, return_inverse=True)
+    latitudes = np.array(
+        [math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / math.pow(2, zoom))))) for row, zoom in rows],
+        dtype=np.float64,
+    )
+    return latitudes[inverse.reshape(-1)]
+
+
+@dataclass
+class TileCatalog:
+    """XYZ tiles of a directory, parsed once from their filenames into arrays.
+
+    Bounds are computed for all tiles at once with the same formulas as
+    ``mercantile.xy_bounds`` and ``mercantile.bounds``, so no tile file has
+    to be opened to recover its georeference.
+
+    Example::
+
+        catalog = TileCatalog.from_directory("data/input", "*.png")
+        bounds = catalog.bounds(epsg=3857)
+        right = catalog.neighbour(0, dx=1, dy=0)
+    """
+
+    paths: list[str]
+    x: np.ndarray
+    y: np.ndarray
+    z: np.ndarray
+    _positions: dict[tuple[int, int, int], int] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        xyz = zip(self.x.tolist(), self.y.tolist(), self.z.tolist(), strict=True)
+        self._positions = {tile: position for position, tile in enumerate(xyz)}
+
+    @classmethod
+    def from_paths(cls, paths: list[str]) -> "TileCatalog":
+        """Build a catalog from tile file paths."""
+        xyz = np.array([xyz_from_filename(path) for path in paths], dtype=np.int64).reshape(-1, 3)
+        return cls(list(paths), xyz[:, 0], xyz[:, 1], xyz[:, 2])
+
+    @classmethod
+    def from_directory(cls, directory: str, pattern: str = "*.png") -> "TileCatalog":
+        """Build a catalog from the tile files in a directory, sorted by name."""
+        return cls.from_paths(sorted(glob(os.path.join(directory, pattern))))
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    @property
+    def tile_ids(self) -> list[str]:
+        return [tile_id_from_filename(path) for path in self.paths]
+
+    def subset(self, positions) -> "TileCatalog":
+        """Return a catalog of the tiles at the given positions."""
+        positions = np.asarray(positions, dtype=np.int64)
+        return TileCatalog(
+            [self.paths[position] for position in positions], self.x[positions], self.y[positions], self.z[positions]
+        )
+
+    def index(self, x: int, y: int, z: int) -> int | None:
+        """Return the position of a tile in the catalog, or None if it is absent."""
+        return self._positions.get((x, y, z))
+
+    def neighbour(self, position: int, dx: int, dy: int) -> int | None:
+        """Return the position of the tile offset by (dx, dy) at the same zoom, or None."""
+        return self.index(int(self.x[position]) + dx, int(self.y[position]) + dy, int(self.z[position]))
+
+    def bounds(self, epsg: int = 3857) -> np.ndarray:
+        """Return an (N, 4) array of (left, bottom, right, top) bounds in EPSG:3857 or EPSG:4326."""
+        z2 = np.power(2.0, self.z)
+
+        if epsg == 3857:
+            tile_size = CE / z2
+            left = self.x * tile_size - CE / 2
+            top = CE / 2 - self.y * tile_size
+            return np.column_stack([left, top - tile_size, left + tile_size, top])
+
+        west = self.x / z2 * 360.0 - 180.0
+        east = (self.x + 1) / z2 * 360.0 - 180.0
+        north = _latitudes(self.y, self.z)
+        south = _latitudes(self.y + 1, self.z)
+        return np.column_stack([west, south, east, north])
+
+    def extent(self, epsg: int = 3857) -> tuple[float, float, float, float]:
+        """Return the union of the bounds of all tiles."""
+        bounds = self.bounds(epsg=epsg)
+        return (
+            float(bounds[:, 0].min()),
+            float(bounds[:, 1].min()),
+            float(bounds[:, 2].max()),
+            float(bounds[:, 3].max()),
+        )
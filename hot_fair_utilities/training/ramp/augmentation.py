@@ -0,0 +1,191 @@
+import math
+
+import tensorflow as tf
+
+# OpenCV flags of the albumentations parameters and their equivalents in ImageProjectiveTransformV3
+INTERPOLATIONS = {"INTER_NEAREST": "NEAREST", "INTER_LINEAR": "BILINEAR"}
+BORDER_MODES = {
+    "BORDER_CONSTANT": "CONSTANT",
+    "BORDER_REFLECT": "REFLECT",
+    "BORDER_REFLECT_101": "REFLECT",
+    "BORDER_REPLICATE": "NEAREST",
+    "BORDER_WRAP": "WRAP",
+}
+
+
+def _applied(images, p: float, seed) -> tf.Tensor:
+    """Draw for each sample of a batch whether a transform with probability p applies, shaped (batch, 1, 1, 1)."""
+    return tf.reshape(tf.random.stateless_uniform([tf.shape(images)[0]], seed) < p, [-1, 1, 1, 1])
+
+
+def _uniform(images, low: float, high: float, seed) -> tf.Tensor:
+    """Draw one value per sample of a batch, shaped (batch, 1, 1, 1)."""
+    return tf.random.stateless_uniform([tf.shape(images)[0], 1, 1, 1], seed, low, high)
+
+
+def _factor_range(value, name: str) -> tuple[float, float]:
+    """Range of an albumentations ColorJitter factor, given as a float v for [max(0, 1 - v), 1 + v] or a range."""
+    if isinstance(value, int | float):
+        assert value >= 0, f"{name} must be non-negative"
+        return max(0.0, 1 - value), 1 + value
+    return tuple(value)
+
+
+def _rotation_transforms(angles: tf.Tensor, height: tf.Tensor, width: tf.Tensor) -> tf.Tensor:
+    """Projective transforms rotating images by angles (radians) about their centers, shaped (batch, 8)."""
+    cos, sin = tf.cos(angles), tf.sin(angles)
+    x_offset = ((width - 1) - (cos * (width - 1) - sin * (height - 1))) / 2
+    y_offset = ((height - 1) - (sin * (width - 1) + cos * (height - 1))) / 2
+    zeros = tf.zeros_like(angles)
+    return tf.stack([cos, -sin, x_offset, sin, cos, y_offset, zeros, zeros], axis=1)
+
+
+def _project(images: tf.Tensor, transforms: tf.Tensor, interpolation: str, fill_mode: str, fill_value) -> tf.Tensor:
+    return tf.raw_ops.ImageProjectiveTransformV3(
+        images=images,
+        transforms=transforms,
+        output_shape=tf.shape(images)[1:3],
+        fill_value=float(fill_value),
+        interpolation=interpolation,
+        fill_mode=fill_mode,
+    )
+
+
+def rotate(
+    limit=90,
+    interpolation="INTER_LINEAR",
+    border_mode="BORDER_REFLECT_101",
+    value=0.0,
+    mask_value=0,
+    p: float = 0.5,
+):
+    """Batched albumentations.Rotate: rotate each sample by a random angle in [-limit, limit] degrees.
+
+    The masks are rotated with the images, always with nearest
+    interpolation. "BORDER_REFLECT_101" reflects like "BORDER_REFLECT".
+    """
+    low, high = (-limit, limit) if isinstance(limit, int | float) else limit
+    if isinstance(value, list | tuple):
+        assert len(set(value)) == 1, "Rotate value must be the same for every band"
+        value = value[0]
+    interpolation, fill_mode = INTERPOLATIONS[interpolation], BORDER_MODES[border_mode]
+
+    def transform(images, masks, seed):
+        applied_seed, angle_seed = tf.unstack(tf.random.experimental.stateless_split(seed, 2), num=2)
+        angles = tf.where(_applied(images, p, applied_seed), _uniform(images, low, high, angle_seed), 0.0)
+        shape = tf.cast(tf.shape(images), tf.float32)
+        transforms = _rotation_transforms(tf.reshape(angles, [-1]) * math.pi / 180, shape[1], shape[2])
+        images = _project(images, transforms, interpolation, fill_mode, value)
+        masks = tf.cast(_project(tf.cast(masks, tf.float32), transforms, "NEAREST", fill_mode, mask_value), masks.dtype)
+        return images, masks
+
+    return transform
+
+
+def color_jitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.2, p: float = 0.5):
+    """Batched albumentations.ColorJitter of images in [0, 1]; the masks are unchanged.
+
+    Brightness, contrast, saturation and hue are jittered in that order,
+    rather than in a random order per sample.
+    """
+    brightness = _factor_range(brightness, "brightness")
+    contrast = _factor_range(contrast, "contrast")
+    saturation = _factor_range(saturation, "saturation")
+    hue = (-hue, hue) if isinstance(hue, int | float) else tuple(hue)
+
+    def transform(images, masks, seed):
+        seeds = tf.unstack(tf.random.experimental.stateless_split(seed, 5), num=5)
+        applied = _applied(images, p, seeds[0])
+        images = tf.clip_by_value(images * tf.where(applied, _uniform(images, *brightness, seeds[1]), 1.0), 0, 1)
+
+        mean = tf.reduce_mean(tf.image.rgb_to_grayscale(images), axis=[1, 2, 3], keepdims=True)
+        contrasts = tf.where(applied, _uniform(images, *contrast, seeds[2]), 1.0)
+        images = tf.clip_by_value(mean + (images - mean) * contrasts, 0, 1)
+
+        gray = tf.image.rgb_to_grayscale(images)
+        saturations = tf.where(applied, _uniform(images, *saturation, seeds[3]), 1.0)
+        images = tf.clip_by_value(gray + (images - gray) * saturations, 0, 1)
+
+        hsv = tf.image.rgb_to_hsv(images)
+        hues = tf.math.floormod(hsv[..., :1] + tf.where(applied, _uniform(images, *hue, seeds[4]), 0.0), 1.0)
+        images = tf.image.hsv_to_rgb(tf.concat([hues, hsv[..., 1:]], axis=-1))
+        return images, masks
+
+    return transform
+
+
+def _flip(axis: int):
+    def flip(p: float = 0.5):
+        def transform(images, masks, seed):
+            applied = _applied(images, p, seed)
+            return (
+                tf.where(applied, tf.reverse(images, [axis]), images),
+                tf.where(applied, tf.reverse(masks, [axis]), masks),
+            )
+
+        return transform
+
+    return flip
+
+
+# Batched implementations by albumentations transform name, as used in RAMP_CONFIG["augmentation"]["aug_list"]
+BATCH_AUGMENTATIONS = {
+    "Rotate": rotate,
+    "ColorJitter": color_jitter,
+    "HorizontalFlip": _flip(2),
+    "VerticalFlip": _flip(1),
+}
+
+
+def get_batch_augmentation_fn(cfg):
+    """Build a batched augmentation from the augmentation section of a ramp config.
+
+    This is the graph-side counterpart of ramp's ``get_augmentation_fn``:
+    the same "aug_list" and "aug_parms" are applied with TensorFlow ops to
+    whole (images, masks) batches, inside the input pipeline, instead of
+    calling albumentations on every sample through tf.numpy_function.
+
+    The random draws are stateless, so a batch is augmented the same way
+    whenever it is given the same seed, whatever the order and parallelism
+    of the calls.
+
+    Returns:
+        A function mapping a batch of float32 images in [0, 1], their masks
+        and a shape [2] integer seed to augmented batches, for use with
+        augment_batches.
+    """
+    transforms = []
+    for augment_name, aug_parms in zip(cfg["augmentation"]["aug_list"], cfg["augmentation"]["aug_parms"], strict=True):
+        if augment_name not in BATCH_AUGMENTATIONS:
+            raise ValueError(
+                f"{augment_name} has no batched implementation, supported: {', '.join(BATCH_AUGMENTATIONS)}"
+            )
+        transforms.append(BATCH_AUGMENTATIONS[augment_name](**aug_parms))
+
+    def augment(images, masks, seed):
+        if not transforms:
+            return images, masks
+        seeds = tf.unstack(tf.random.experimental.stateless_split(seed, len(transforms)), num=len(transforms))
+        for transform, transform_seed in zip(transforms, seeds, strict=True):
+            images, masks = transform(images, masks, transform_seed)
+        return images, masks
+
+    return augment
+
+
+def augment_batches(batches: tf.data.Dataset, augment, seed: int, skip_batches: int = 0) -> tf.data.Dataset:
+    """Augment a stream of batches in parallel with a function of get_batch_augmentation_fn.
+
+    Each batch is augmented with a seed made of seed and its position in
+    the stream, so the batches left after skipping the first skip_batches
+    are augmented as they would be without skipping. batches must already
+    be repeated, or every epoch would be augmented alike.
+    """
+    return (
+        batches.enumerate()
+        .skip(skip_batches)
+        .map(
+            lambda position, batch: augment(*batch, tf.stack([tf.constant(seed, tf.int64), position])),
+            num_parallel_calls=tf.data.AUTOTUNE,
+        )
+    )
@@ -0,0 +1,210 @@
+import logging
+import math
+import os
+import pickle
+import random
+import shutil
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+from ramp.training.callback_constructors import get_accuracy_name
+from tensorflow import keras
+
+from ...utils import atomic_write
+
+log = logging.getLogger(__name__)
+
+BEST_WEIGHTS_FILENAME = "best.weights.h5"
+TRAINING_STATE_FILENAME = "state.pkl"
+
+# Attributes making up the state of the callbacks of a ramp training, by callback class name
+CALLBACK_STATE_ATTRIBUTES = {
+    "BestCheckpoint": ("best", "best_epoch"),
+    "EarlyStopping": ("wait", "best", "stopped_epoch"),
+    "CyclicLR": ("clr_iterations", "trn_iterations", "history"),
+}
+
+
+class BestCheckpoint(keras.callbacks.Callback):
+    """Track the best epoch of a training and keep a single checkpoint of it.
+
+    The weights of the best epoch are kept in memory and atomically written
+    over one HDF5 weights file, so the checkpoint on disk is always
+    complete. When the training ends, the best weights are restored into
+    the model, which is exported once as a ".h5" model.
+
+    Args:
+        checkpoint_dir: Directory of the checkpoint and of the exported model.
+        monitor: Metric of the logs to track, e.g. "val_sparse_categorical_accuracy".
+        mode: "max" if higher values of the metric are better, "min" otherwise.
+        export_name: Prefix of the file name of the exported model.
+    """
+
+    def __init__(self, checkpoint_dir: str, monitor: str, mode: str = "max", export_name: str = "model") -> None:
+        super().__init__()
+        assert mode in ("max", "min"), f"mode must be 'max' or 'min', got {mode}"
+        self.checkpoint_dir = checkpoint_dir
+        self.monitor = monitor
+        self.mode = mode
+        self.export_name = export_name
+        self.best = -math.inf if mode == "max" else math.inf
+        self.best_epoch: int | None = None
+        self.best_weights = None
+        self.export_path: str | None = None
+
+    @property
+    def weights_path(self) -> str:
+        return os.path.join(self.checkpoint_dir, BEST_WEIGHTS_FILENAME)
+
+    def _improved(self, value: float) -> bool:
+        return value > self.best if self.mode == "max" else value < self.best
+
+    def on_epoch_end(self, epoch, logs=None):
+        value = (logs or {}).get(self.monitor)
+        if value is None:
+            log.warning("%s is not in the logs of epoch %d, the best epoch is not tracked", self.monitor, epoch + 1)
+            return
+        if not self._improved(value):
+            return
+
+        self.best, self.best_epoch = float(value), epoch
+        self.best_weights = self.model.get_weights()
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        with atomic_write(self.weights_path) as temp_path:
+            self.model.save_weights(temp_path, save_format="h5")
+        log.info("Epoch %d: %s improved to %.4f, checkpoint saved", epoch + 1, self.monitor, self.best)
+
+    def on_train_end(self, logs=None):
+        if self.best_epoch is None:
+            log.warning("No epoch reported %s, no model is exported", self.monitor)
+            return
+        if self.best_weights is not None:
+            self.model.set_weights(self.best_weights)
+        else:
+            # The best epoch is from before a resume, its weights are only on disk
+            self.model.load_weights(self.weights_path)
+        self.export_path = os.path.join(
+            self.checkpoint_dir, f"{self.export_name}_{self.best_epoch + 1:03d}_{self.best:.3f}.h5"
+        )
+        self.model.save(self.export_path)
+        log.info("Exported the model of epoch %d to %s", self.best_epoch + 1, self.export_path)
+
+
+def load_training_state(state_dir: str) -> dict | None:
+    """Load the training state saved by TrainingState, or None if there is none."""
+    state_path = os.path.join(state_dir, TRAINING_STATE_FILENAME)
+    if not os.path.isfile(state_path):
+        return None
+    with open(state_path, "rb") as file:
+        return pickle.load(file)
+
+
+class TrainingState(keras.callbacks.Callback):
+    """Save the state of a training after every epoch, and restore it to resume the training.
+
+    Each epoch writes the model weights, the optimizer state and the global
+    TensorFlow random generator to a new "epoch-<n>" checkpoint. It then
+    replaces "state.pkl", which holds the number of completed epochs, the
+    timestamp of the run, the logs of every epoch so far, the Python and
+    NumPy random states and the state of the other callbacks, and names the
+    checkpoint. The previous
+    checkpoint is only removed after that, so an interrupted training always
+    leaves a complete state behind.
+
+    It must be the last callback, so restoring the other callbacks comes
+    after their own on_train_begin.
+
+    The model, optimizer, callbacks and random states continue where they
+    stopped. The tf.data pipeline of data_pipeline is seeded and skips the
+    batches of the completed epochs, so the remaining epochs see the batches
+    of an uninterrupted training, with the same batched augmentation.
+    Per-sample albumentations draws are not reproducible, resumed or not.
+    ramp's own input pipeline cannot be positioned: it starts over from its
+    first batch, so the remaining epochs see the batches of the first ones
+    again.
+
+    Args:
+        state_dir: Directory of the training state.
+        timestamp: Timestamp of the run, reused when resuming so the
+            checkpoints and logs stay in the same directories.
+        callbacks: Callbacks of the training whose state is saved, see
+            CALLBACK_STATE_ATTRIBUTES.
+        resume_state: State returned by load_training_state to restore when
+            the training begins, or None to start from scratch.
+    """
+
+    def __init__(self, state_dir: str, timestamp: str, callbacks: list, resume_state: dict | None = None) -> None:
+        super().__init__()
+        self.state_dir = state_dir
+        self.timestamp = timestamp
+        self.tracked_callbacks = {
+            type(callback).__name__: callback
+            for callback in callbacks
+            if type(callback).__name__ in CALLBACK_STATE_ATTRIBUTES
+        }
+        self.resume_state = resume_state
+        self.history: list[dict] = []
+
+    def _checkpoint(self) -> tf.train.Checkpoint:
+        return tf.train.Checkpoint(
+            model=self.model,
+            optimizer=self.model.optimizer,
+            generator=tf.random.get_global_generator(),
+        )
+
+    def on_train_begin(self, logs=None):
+        if self.resume_state is None:
+            return
+        state = self.resume_state
+        self._checkpoint().read(os.path.join(self.state_dir, state["checkpoint"])).expect_partial()
+        random.setstate(state["python_random"])
+        np.random.set_state(state["numpy_random"])
+        self.history = list(state.get("history", []))
+        for name, attributes in state["callbacks"].items():
+            if name in self.tracked_callbacks:
+                for attribute, value in attributes.items():
+                    setattr(self.tracked_callbacks[name], attribute, value)
+        log.info("Restored the training state of epoch %d from %s", state["epoch"], self.state_dir)
+
+    def on_epoch_end(self, epoch, logs=None):
+        checkpoint_dir = f"epoch-{epoch + 1:03d}"
+        self.history.append({name: float(value) for name, value in (logs or {}).items()})
+        os.makedirs(self.state_dir, exist_ok=True)
+        self._checkpoint().write(os.path.join(self.state_dir, checkpoint_dir, "checkpoint"))
+
+        state = {
+            "epoch": epoch + 1,
+            "timestamp": self.timestamp,
+            "checkpoint": os.path.join(checkpoint_dir, "checkpoint"),
+            "history": self.history,
+            "python_random": random.getstate(),
+            "numpy_random": np.random.get_state(),
+            "callbacks": {
+                name: {attribute: getattr(callback, attribute) for attribute in CALLBACK_STATE_ATTRIBUTES[name]}
+                for name, callback in self.tracked_callbacks.items()
+            },
+        }
+        state_path = os.path.join(self.state_dir, TRAINING_STATE_FILENAME)
+        with atomic_write(state_path) as temp_path, open(temp_path, "wb") as file:
+            pickle.dump(state, file)
+
+        for entry in os.listdir(self.state_dir):
+            if entry.startswith("epoch-") and entry != checkpoint_dir:
+                shutil.rmtree(os.path.join(self.state_dir, entry))
+
+
+def get_best_checkpoint_callback_fn(cfg) -> BestCheckpoint:
+    """Construct the BestCheckpoint callback of a ramp config, in place of ramp's ModelCheckpoint.
+
+    It monitors the validation value of the first metric, in the
+    "model_checkpts_dir/<timestamp>" directory ramp's checkpoints used.
+    """
+    timestamp = cfg["timestamp"]
+    models_dir = Path(os.environ["RAMP_HOME"]) / cfg["model_checkpts"]["model_checkpts_dir"] / timestamp
+    return BestCheckpoint(
+        str(models_dir),
+        f"val_{get_accuracy_name(cfg)}",
+        mode=cfg["model_checkpts"]["model_checkpt_callback_parms"]["mode"],
+        export_name=f"model_{timestamp}",
+    )
@@ -38,6 +38,13 @@ RAMP_CONFIG = {
         "val_img_dir": "ramp-data/TRAIN/HOTOSM/1/val-chips",
         "val_mask_dir": "ramp-data/TRAIN/HOTOSM/1/val-multimasks",
     },
+    "tf_data": {
+        "use_tf_data": False,
+        "cache": "memory",
+        "cache_dir": "ramp-data/TRAIN/HOTOSM/1/tf-cache",
+        "packed_store_dir": "ramp-data/TRAIN/HOTOSM/1/packed",
+        "packed_mask": "multimasks",
+    },
     "num_classes": 4,
     "num_epochs": 20,
     "batch_size": 8,
@@ -70,6 +77,7 @@ RAMP_CONFIG = {
     },
     "augmentation": {
         "use_aug": True,
+        "batched": False,
         "get_augmentation_fn_name": "get_augmentation_fn",
         "aug_list": ["Rotate", "ColorJitter"],
         "aug_parms": [
@@ -118,9 +126,13 @@ RAMP_CONFIG = {
     "model_checkpts": {
         "use_model_checkpts": True,
         "model_checkpts_dir": "ramp-data/TRAIN/HOTOSM/1/model-checkpts",
-        "get_model_checkpt_callback_fn_name": "get_model_checkpt_callback_fn",
+        "get_model_checkpt_callback_fn_name": "get_best_checkpoint_callback_fn",
         "model_checkpt_callback_parms": {"mode": "max", "save_best_only": False},
     },
+    "training_state": {
+        "use_training_state": False,
+        "training_state_dir": "ramp-data/TRAIN/HOTOSM/1/training-state",
+    },
     "feedback": {"freeze_layers": False},
     "random_seed": 20220523,
 }
@@ -0,0 +1,213 @@
+import logging
+import os
+import random
+from functools import partial
+from glob import glob
+
+import numpy as np
+import rasterio
+import tensorflow as tf
+from ramp.data_mgmt.data_generator import process_data, reset_shapes, resize_it
+
+from ...preprocessing.packed_store import PACKED_INDEX_FILENAME, PackedStore
+from ...tile_catalog import tile_id_from_filename
+from .augmentation import augment_batches
+
+log = logging.getLogger(__name__)
+
+# Seeds of ramp's training_batches_from_gtiff_dirs, so both pipelines shuffle and augment alike
+TF_GLOBAL_SEED = 20220607
+PY_SEED = 303041
+
+CACHE_MODES = ("memory", "file")
+
+
+def _read_image(path: bytes) -> np.ndarray:
+    """Read a chip channels-last as float32, divided by its maximum like ramp."""
+    with rasterio.open(path.decode()) as src:
+        image = np.moveaxis(src.read(out_dtype=np.float32), 0, -1)
+    return image / np.max(image)
+
+
+def _read_mask(path: bytes) -> np.ndarray:
+    """Read a mask channels-last as uint8."""
+    with rasterio.open(path.decode()) as src:
+        return np.moveaxis(src.read(out_dtype=np.uint8), 0, -1)
+
+
+def _read_packed(store: PackedStore, mask: str, position: np.int64) -> tuple[np.ndarray, np.ndarray]:
+    """Read a chip and its mask from a packed store, in the form of _read_image and _read_mask."""
+    image = store.chips[position].astype(np.float32)
+    return image / np.max(image), store.masks[mask][position][..., np.newaxis]
+
+
+def _open_packed_store(packed_store_dir: str | None, mask: str | None) -> PackedStore | None:
+    """Open the packed store written by preprocess(pack=True), if it exists and holds the mask."""
+    if packed_store_dir is None or not os.path.isfile(os.path.join(packed_store_dir, PACKED_INDEX_FILENAME)):
+        return None
+    store = PackedStore.open(packed_store_dir)
+    if mask not in store.masks:
+        log.info("Packed store %s has no %s, reading GeoTIFFs", packed_store_dir, mask)
+        return None
+    return store
+
+
+def _decoded_pairs(
+    image_dir,
+    mask_dir,
+    input_image_size,
+    output_image_size,
+    packed_store_dir: str | None = None,
+    packed_mask: str | None = None,
+) -> tuple[tf.data.Dataset, int]:
+    """Build a dataset of decoded (image, mask) pairs, in the sorted order of the chips.
+
+    Images and masks are read in parallel and resized like ramp's
+    generators. Masks are matched to images by tile id rather than by
+    listing order. The pairs come from the packed store when it holds every
+    chip of image_dir, and from the GeoTIFFs otherwise.
+
+    Returns:
+        The dataset and its number of pairs.
+    """
+    image_paths = sorted(glob(os.path.join(image_dir, "*.tif")))
+    tile_ids = [tile_id_from_filename(path) for path in image_paths]
+    assert image_paths, f"No chips found in {image_dir}"
+
+    store = _open_packed_store(packed_store_dir, packed_mask)
+    if store is not None and all(tile_id in store for tile_id in tile_ids):
+        log.info("Reading %d chips of %s from packed store %s", len(tile_ids), image_dir, packed_store_dir)
+        read = partial(_read_packed, store, packed_mask)
+        pairs = tf.data.Dataset.from_tensor_slices(store.positions(tile_ids)).map(
+            lambda position: tf.numpy_function(read, [position], [tf.float32, tf.uint8]),
+            num_parallel_calls=tf.data.AUTOTUNE,
+        )
+    else:
+        mask_paths = [os.path.join(mask_dir, f"{tile_id}.mask.tif") for tile_id in tile_ids]
+        missing = [path for path in mask_paths if not os.path.isfile(path)]
+        assert not missing, f"{len(missing)} chips have no mask in {mask_dir}, e.g. {missing[0]}"
+        pairs = tf.data.Dataset.from_tensor_slices((image_paths, mask_paths)).map(
+            lambda image_path, mask_path: (
+                tf.numpy_function(_read_image, [image_path], tf.float32),
+                tf.numpy_function(_read_mask, [mask_path], tf.uint8),
+            ),
+            num_parallel_calls=tf.data.AUTOTUNE,
+        )
+
+    pairs = pairs.map(
+        lambda image, mask: (
+            resize_it(image, [*input_image_size, 3], output_image_size, "bilinear"),
+            resize_it(mask, [*input_image_size, 1], output_image_size, "nearest"),
+        ),
+        num_parallel_calls=tf.data.AUTOTUNE,
+    )
+    return pairs, len(image_paths)
+
+
+def _cache(dataset: tf.data.Dataset, cache: str | None, cache_dir: str | None, name: str) -> tf.data.Dataset:
+    """Cache a dataset in memory or in files of cache_dir, dropping the files of a previous run."""
+    if cache is None:
+        return dataset
+    assert cache in CACHE_MODES, f"cache must be one of {CACHE_MODES} or None, got {cache}"
+    if cache == "memory":
+        return dataset.cache()
+    assert cache_dir is not None, "cache_dir is required to cache in files"
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_prefix = os.path.join(cache_dir, name)
+    # A file cache is reused as is when it exists, so stale data must not survive a new run
+    for stale in glob(f"{cache_prefix}*"):
+        os.remove(stale)
+    return dataset.cache(cache_prefix)
+
+
+def training_batches(
+    image_dir,
+    mask_dir,
+    batch_size: int,
+    input_image_size,
+    output_image_size,
+    transforms=None,
+    batch_transforms=None,
+    cache: str | None = "memory",
+    cache_dir: str | None = None,
+    packed_store_dir: str | None = None,
+    packed_mask: str | None = None,
+    skip_batches: int = 0,
+) -> tf.data.Dataset:
+    """Build the training batches of ramp with a parallel tf.data pipeline.
+
+    The batches are those of ramp's ``training_batches_from_gtiff_dirs``:
+    decoded pairs are cached, shuffled over the whole dataset, augmented,
+    batched and repeated. Decoding and augmentation run on parallel calls,
+    and batches are prefetched while the model trains.
+
+    The pipeline is seeded, so it yields the same batches every time it is
+    built, apart from the draws of per-sample albumentations transforms,
+    which run in parallel Python calls. A resumed training skips the
+    batches of its completed epochs to continue the stream where the
+    interrupted training stopped.
+
+    Args:
+        image_dir: Directory of the training chips.
+        mask_dir: Directory of the matching "<tile id>.mask.tif" masks.
+        batch_size: Number of pairs per batch.
+        input_image_size: (rows, columns) of the chips.
+        output_image_size: (rows, columns) the pairs are resized to.
+        transforms: Albumentations transform to augment the pairs, or None.
+        batch_transforms: Function of augmentation.get_batch_augmentation_fn
+            augmenting whole batches with TensorFlow ops, or None.
+        cache: "memory" or "file" to cache the decoded pairs after the first
+            epoch, or None to decode them every epoch.
+        cache_dir: Directory of the cache files, for cache="file".
+        packed_store_dir: Packed store of preprocess(pack=True) to read the
+            pairs from instead of the GeoTIFFs, if it exists.
+        packed_mask: Mask array of the packed store, e.g. "binarymasks".
+        skip_batches: Number of batches to drop from the start of the stream.
+    """
+    tf.random.set_seed(TF_GLOBAL_SEED)
+    random.seed(PY_SEED)
+
+    pairs, n_pairs = _decoded_pairs(
+        image_dir, mask_dir, input_image_size, output_image_size, packed_store_dir, packed_mask
+    )
+    pairs = _cache(pairs, cache, cache_dir, "train").shuffle(n_pairs)
+    if transforms is not None:
+        pairs = pairs.map(
+            partial(process_data, img_shape=output_image_size, transforms=transforms),
+            num_parallel_calls=tf.data.AUTOTUNE,
+        ).map(partial(reset_shapes, image_shape=output_image_size), num_parallel_calls=tf.data.AUTOTUNE)
+    # Skipping still reads the skipped pairs, which replays the shuffles
+    batches = pairs.batch(batch_size).repeat()
+    if batch_transforms is not None:
+        batches = augment_batches(batches, batch_transforms, TF_GLOBAL_SEED, skip_batches)
+    else:
+        batches = batches.skip(skip_batches)
+    return batches.prefetch(tf.data.AUTOTUNE)
+
+
+def validation_batches(
+    image_dir,
+    mask_dir,
+    batch_size: int,
+    input_image_size,
+    output_image_size,
+    validation_steps: int,
+    cache: str | None = "memory",
+    cache_dir: str | None = None,
+    packed_store_dir: str | None = None,
+    packed_mask: str | None = None,
+) -> tf.data.Dataset:
+    """Build the validation batches of ramp with a parallel tf.data pipeline.
+
+    Like ramp's ``test_batches_from_gtiff_dirs``, the batches are not
+    shuffled, augmented or repeated. Only the pairs of the validation steps
+    are kept, so a cache is complete after the first validation.
+
+    Args:
+        validation_steps: Number of batches evaluated per validation.
+
+    See training_batches for the other arguments.
+    """
+    pairs, _ = _decoded_pairs(image_dir, mask_dir, input_image_size, output_image_size, packed_store_dir, packed_mask)
+    pairs = _cache(pairs.take(validation_steps * batch_size), cache, cache_dir, "val")
+    return pairs.batch(batch_size).prefetch(tf.data.AUTOTUNE)
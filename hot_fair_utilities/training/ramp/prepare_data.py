@@ -7,6 +7,8 @@ import random
 from pathlib import Path
 from shutil import copytree, move, rmtree
 
+from ...utils import link_file
+
 
 class RaiseError(Exception):
     def __init__(self, message):
@@ -58,7 +60,14 @@ def _move_files_for_validation(source_dir: Path, target_dir: Path, val_filenames
 
 
 def split_training_2_validation(input_path, output_path, multimasks=False):
-    """Split training data into training and validation sets for ramp."""
+    """Split training data into training and validation sets for ramp.
+
+    The preprocessed directory is mirrored into output_path with hardlinks
+    rather than copied, so the split only costs file metadata: the chips and
+    masks of the validation set are then renamed into the "val-" directories.
+    The split is also written to "fair_split_train.csv" and
+    "fair_split_val.csv".
+    """
 
     # Define the source and destination paths
     src_path = input_path
@@ -68,8 +77,8 @@ def split_training_2_validation(input_path, output_path, multimasks=False):
     if os.path.exists(dst_path):
         # Delete the directory and its contents
         rmtree(dst_path)
-    # Use the copytree function to copy the source directory and its contents to the destination directory
-    copytree(src_path, dst_path)
+    # Mirror the source directory with links, the training only reads the chips and masks
+    copytree(src_path, dst_path, copy_function=link_file)
 
     destination_path = Path(dst_path)
     chips_dir = destination_path / "chips"
@@ -28,7 +28,11 @@ from ramp.training import (
 from ramp.training.augmentation_constructors import get_augmentation_fn
 from ramp.utils.misc_ramp_utils import get_num_files
 
+from . import callbacks
+from .augmentation import augment_batches, get_batch_augmentation_fn
+from .callbacks import TrainingState, load_training_state
 from .config import RAMP_CONFIG
+from .data_pipeline import TF_GLOBAL_SEED, training_batches, validation_batches
 
 log = logging.getLogger(__name__)
 
@@ -53,7 +57,17 @@ sm.set_framework("tf.keras")
 working_ramp_home = os.environ["RAMP_HOME"]
 
 
-def manage_fine_tuning_config(output_path, num_epochs, batch_size, freeze_layers, multimasks=False):
+def manage_fine_tuning_config(
+    output_path,
+    num_epochs,
+    batch_size,
+    freeze_layers,
+    multimasks=False,
+    tf_data=False,
+    cache="memory",
+    batched_augmentation=False,
+    resumable=False,
+):
 
     dst_path = os.path.join(output_path, "ramp_fair_config_finetune.json")
 
@@ -72,6 +86,16 @@ def manage_fine_tuning_config(output_path, num_epochs, batch_size, freeze_layers
     else:
         data["datasets"]["val_mask_dir"] = f"{output_path}/val-binarymasks"
 
+    # input pipeline: ramp's generators, or the parallel tf.data pipeline reading the packed store if any
+    data["tf_data"]["use_tf_data"] = tf_data
+    data["tf_data"]["cache"] = cache
+    data["tf_data"]["cache_dir"] = f"{output_path}/tf-cache"
+    data["tf_data"]["packed_store_dir"] = f"{output_path}/packed"
+    data["tf_data"]["packed_mask"] = "multimasks" if multimasks else "binarymasks"
+
+    # augment whole batches with TensorFlow ops instead of albumentations per sample
+    data["augmentation"]["batched"] = batched_augmentation
+
     # epoch batchconfig
     data["num_epochs"] = num_epochs
     data["batch_size"] = batch_size
@@ -87,6 +111,9 @@ def manage_fine_tuning_config(output_path, num_epochs, batch_size, freeze_layers
     data["model_checkpts"]["model_checkpts_dir"] = f"{output_path}/model-checkpts"
     # save best models only
     data["model_checkpts"]["model_checkpt_callback_parms"]["save_best_only"] = True
+    # training state to resume from, saved every epoch when the training is resumable
+    data["training_state"]["use_training_state"] = resumable
+    data["training_state"]["training_state_dir"] = f"{output_path}/training-state"
     # Open the destination file and write the modified data
     with open(dst_path, "w") as f:
         json.dump(data, f)
@@ -94,12 +121,36 @@ def manage_fine_tuning_config(output_path, num_epochs, batch_size, freeze_layers
     return data
 
 
-def run_main_train_code(cfg):
+def run_main_train_code(cfg, resume=False):
+    """Train a ramp model as configured.
+
+    Args:
+        cfg: Ramp config, e.g. from manage_fine_tuning_config.
+        resume: Continue from the training state saved after the last
+            completed epoch of an interrupted run, if there is one.
+
+    Returns:
+        The BestCheckpoint callback holding the best validation accuracy and
+        the path of the exported model, or None without model checkpoints.
+    """
     discard_experiment = False
     if "discard_experiment" in cfg:
         discard_experiment = cfg["discard_experiment"]
 
-    cfg["timestamp"] = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    # configs without a training_state section are not resumable
+    training_state_cfg = cfg.get("training_state", {})
+    training_state_dir = None
+    if "training_state_dir" in training_state_cfg:
+        training_state_dir = str(Path(working_ramp_home) / training_state_cfg["training_state_dir"])
+    resume_state = load_training_state(training_state_dir) if resume and training_state_dir is not None else None
+    if resume_state is not None:
+        # continue in the checkpoint and log directories of the interrupted run
+        cfg["timestamp"] = resume_state["timestamp"]
+        log.info("Resuming training after epoch %d", resume_state["epoch"])
+    else:
+        if resume:
+            log.info("No training state found in %s, training from scratch", training_state_dir)
+        cfg["timestamp"] = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
 
     # specify a function that will construct the loss function
     get_loss_fn_name = cfg["loss"]["get_loss_fn_name"]
@@ -170,8 +221,12 @@ def run_main_train_code(cfg):
 
     #### get the augmentation transform ####
     aug = None
+    batch_aug = None
     if cfg["augmentation"]["use_aug"]:
-        aug = get_augmentation_fn(cfg)
+        if cfg["augmentation"].get("batched"):
+            batch_aug = get_batch_augmentation_fn(cfg)
+        else:
+            aug = get_augmentation_fn(cfg)
 
     ## RUNTIME Parameters
     batch_size = cfg["batch_size"]
@@ -196,35 +251,74 @@ def run_main_train_code(cfg):
 
     train_batches = None
 
-    if aug is not None:
-        train_batches = training_batches_from_gtiff_dirs(
+    if cfg.get("tf_data", {}).get("use_tf_data"):
+        tf_data_cfg = cfg["tf_data"]
+        pipeline_parms = {
+            "cache": tf_data_cfg["cache"],
+            "cache_dir": str(Path(working_ramp_home) / tf_data_cfg["cache_dir"]),
+            "packed_store_dir": str(Path(working_ramp_home) / tf_data_cfg["packed_store_dir"]),
+            "packed_mask": tf_data_cfg["packed_mask"],
+        }
+        train_batches = training_batches(
             train_img_dir,
             train_mask_dir,
             batch_size,
             input_img_shape,
             output_img_shape,
             transforms=aug,
+            batch_transforms=batch_aug,
+            # continue the stream of batches where the interrupted training stopped
+            skip_batches=resume_state["epoch"] * steps_per_epoch if resume_state is not None else 0,
+            **pipeline_parms,
+        )
+        val_batches = validation_batches(
+            val_img_dir,
+            val_mask_dir,
+            batch_size,
+            input_img_shape,
+            output_img_shape,
+            validation_steps,
+            **pipeline_parms,
         )
     else:
-        train_batches = training_batches_from_gtiff_dirs(
-            train_img_dir, train_mask_dir, batch_size, input_img_shape, output_img_shape
+        if resume_state is not None:
+            # ramp's pipeline is not rebuilt at the position it reached, see TrainingState
+            log.warning("Resuming with ramp's input pipeline, which starts over from its first batch")
+        if aug is not None:
+            train_batches = training_batches_from_gtiff_dirs(
+                train_img_dir,
+                train_mask_dir,
+                batch_size,
+                input_img_shape,
+                output_img_shape,
+                transforms=aug,
+            )
+        else:
+            train_batches = training_batches_from_gtiff_dirs(
+                train_img_dir, train_mask_dir, batch_size, input_img_shape, output_img_shape
+            )
+            if batch_aug is not None:
+                train_batches = augment_batches(train_batches, batch_aug, TF_GLOBAL_SEED)
+
+        val_batches = test_batches_from_gtiff_dirs(
+            val_img_dir, val_mask_dir, batch_size, input_img_shape, output_img_shape
         )
 
     assert train_batches is not None, "training batches were not constructed"
 
-    val_batches = test_batches_from_gtiff_dirs(val_img_dir, val_mask_dir, batch_size, input_img_shape, output_img_shape)
-
     assert val_batches is not None, "validation batches were not constructed"
 
     ## Callbacks ##
     callbacks_list = []
+    best_checkpoint = None
 
     if not discard_experiment:
-        # get model checkpoint callback
+        # get model checkpoint callback, keeping the best epoch only
         if cfg["model_checkpts"]["use_model_checkpts"]:
             get_model_checkpt_callback_fn_name = cfg["model_checkpts"]["get_model_checkpt_callback_fn_name"]
-            get_model_checkpt_callback_fn = getattr(callback_constructors, get_model_checkpt_callback_fn_name)
-            callbacks_list.append(get_model_checkpt_callback_fn(cfg))
+            get_model_checkpt_callback_fn = getattr(callbacks, get_model_checkpt_callback_fn_name)
+            best_checkpoint = get_model_checkpt_callback_fn(cfg)
+            callbacks_list.append(best_checkpoint)
 
         # get tensorboard callback
         if cfg["tensorboard"]["use_tb"]:
@@ -254,6 +348,10 @@ def run_main_train_code(cfg):
         get_clr_callback_fn = getattr(callback_constructors, get_clr_callback_fn_name)
         callbacks_list.append(get_clr_callback_fn(cfg))
 
+    # save the training state every epoch, restoring the other callbacks when resuming
+    if training_state_dir is not None and (training_state_cfg.get("use_training_state") or resume_state is not None):
+        callbacks_list.append(TrainingState(training_state_dir, cfg["timestamp"], list(callbacks_list), resume_state))
+
     ## Main training block ##
     n_epochs = cfg["num_epochs"]
     log.info(
@@ -266,11 +364,11 @@ def run_main_train_code(cfg):
     if validation_steps <= 0:
         raise RaiseError("Not enough data for training. Increase images or reduce batch size")
     assert the_model is not None, "model must be initialized before fitting"
-    # FIXME : Make checkpoint
     start = perf_counter()
     history = the_model.fit(
         train_batches,
         epochs=n_epochs,
+        initial_epoch=resume_state["epoch"] if resume_state is not None else 0,
         steps_per_epoch=steps_per_epoch,
         validation_data=val_batches,
         validation_steps=validation_steps,
@@ -279,6 +377,10 @@ def run_main_train_code(cfg):
     end = perf_counter()
     log.info("Training finished in %.1f seconds", end - start)
 
+    if not history.history:
+        log.info("All %d epochs were already trained", n_epochs)
+        return best_checkpoint
+
     log.info("Generating training graphs")
     if not os.path.exists(cfg["graph_location"]):
         os.mkdir(cfg["graph_location"])
@@ -305,3 +407,5 @@ def run_main_train_code(cfg):
     plt.savefig(f"{cfg['graph_location']}/training_accuracy.png")
     plt.clf()
     log.info("Graph saved to %s", cfg["graph_location"])
+
+    return best_checkpoint
@@ -1,7 +1,6 @@
 import logging
 import os
 
-from .cleanup import extract_highest_accuracy_model
 from .prepare_data import split_training_2_validation
 from .run_training import manage_fine_tuning_config, run_main_train_code
 
@@ -17,6 +16,11 @@ def train(
     model_home: str,
     freeze_layers: bool = False,
     multimasks: bool = False,
+    tf_data: bool = False,
+    cache: str | None = "memory",
+    batched_augmentation: bool = False,
+    resumable: bool = False,
+    resume: bool = False,
 ):
     """Trains the input image with base model
 
@@ -31,6 +35,24 @@ def train(
         freeze_layers: Whether to freeze pretrained layers.
         multimasks: Use multimask labels (background, buildings, boundary,
             close_contact) instead of binary masks.
+        tf_data: Feed the model from a parallel tf.data pipeline that caches
+            the decoded chips, reading the packed store of
+            preprocess(pack=True) when there is one, instead of ramp's
+            GeoTIFF generators.
+        cache: How tf_data caches the decoded chips: "memory", "file" to
+            cache them in "tf-cache" in output_path, or None not to cache.
+        batched_augmentation: Apply the configured augmentations to whole
+            batches with TensorFlow ops, in parallel with training, instead
+            of with albumentations on every sample.
+        resumable: Save the model, optimizer and callback state after every
+            epoch to "training-state" in output_path, so an interrupted
+            training can be resumed.
+        resume: Continue an interrupted resumable training in output_path
+            from the state saved after its last completed epoch, reusing its
+            training and validation split, instead of starting over. The
+            resumed training keeps saving its state. With tf_data, the
+            remaining epochs see the batches of an uninterrupted training.
+            ramp's generators start over from their first batch instead.
     Example::
 
         final_accuracy, final_model_path = train(
@@ -57,16 +79,23 @@ def train(
         os.environ["RAMP_HOME"] = model_home
         # Print the environment variables to verify that the new variable was added
         log.info("Starting to prepare data for training")
-        split_training_2_validation(input_path, output_path, multimasks)
+        if resume and os.path.isfile(os.path.join(output_path, "fair_split_train.csv")):
+            log.info("Resuming in %s with its training data", output_path)
+        else:
+            split_training_2_validation(input_path, output_path, multimasks)
         cfg = manage_fine_tuning_config(
             output_path,
             epoch_size,
             batch_size,
             freeze_layers,
             multimasks,
+            tf_data=tf_data,
+            cache=cache,
+            batched_augmentation=batched_augmentation,
+            resumable=resumable or resume,
         )
         log.info("Data is ready for training")
-        run_main_train_code(cfg)
-        log.info("Extracting highest accuracy model")
-        final_accuracy, final_model_path = extract_highest_accuracy_model(output_path)
-        return (final_accuracy, final_model_path)
+        best_checkpoint = run_main_train_code(cfg, resume=resume)
+        assert best_checkpoint is not None and best_checkpoint.export_path is not None, "Couldn't find any models"
+        log.info("Highest accuracy model: %s (%.2f%%)", best_checkpoint.export_path, best_checkpoint.best * 100)
+        return (best_checkpoint.best * 100, best_checkpoint.export_path)
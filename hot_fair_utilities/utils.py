@@ -3,6 +3,7 @@ import logging
 import os
 import sys
 import types
+from contextlib import contextmanager, suppress
 from glob import glob
 
 import pandas as pd
@@ -22,6 +23,36 @@ def patch_tf_experimental_layers():
     sys.modules["tensorflow.keras.layers.experimental"] = module
 
 
+@contextmanager
+def atomic_write(path):
+    """Yield a temporary path to write a file to, renamed to path once the block completes.
+
+    Readers of path see either the previous file or the complete new one,
+    never a partial file. The temporary file is removed if the block raises.
+
+    Example::
+
+        with atomic_write("manifest.json") as temp_path, open(temp_path, "w") as file:
+            json.dump(manifest, file)
+    """
+    temp_path = f"{os.fspath(path)}.tmp"
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+
+
+def link_file(source, target):
+    """Hardlink a file, or symlink it where hardlinks are not possible (e.g. across filesystems)."""
+    try:
+        os.link(source, target)
+    except OSError:
+        os.symlink(os.path.abspath(source), target)
+
+
 def remove_files(pattern: str) -> None:
     """Remove files matching a wildcard."""
     files = glob(pattern)
@@ -1,3 +1,5 @@
+import glob
+import multiprocessing
 import os
 import shutil
 import time
@@ -5,14 +7,217 @@ import time
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 
 # Third party imports
+import geopandas as gpd
+import numpy as np
+import rasterio as rio
 import tensorflow as tf
+from shapely import affinity
+from shapely.geometry import box
 
 from hot_fair_utilities import patch_tf_experimental_layers, polygonize, predict, preprocess
+from hot_fair_utilities.preprocessing.multimasks_from_polygons import multimasks_from_polygons
 from hot_fair_utilities.training.ramp import train
+from hot_fair_utilities.training.ramp.augmentation import get_batch_augmentation_fn
+from hot_fair_utilities.training.ramp.callbacks import load_training_state
+from hot_fair_utilities.training.ramp.config import RAMP_CONFIG
+from hot_fair_utilities.training.ramp.data_pipeline import training_batches
 
 patch_tf_experimental_layers()
 
 
+def make_dense_fixture(preprocess_output: str, output: str, chips: int = 8) -> None:
+    """Label a few chips of preprocess_output with a dense grid of rotated buildings up to 4 pixels apart.
+
+    The sample has few buildings close enough to be in contact, so this
+    exercises the contact rule on many pairs of close, touching and
+    overlapping polygons.
+    """
+    rng = np.random.default_rng(0)
+    shutil.rmtree(output, ignore_errors=True)
+    os.makedirs(f"{output}/chips")
+    os.makedirs(f"{output}/labels")
+    for chip_path in sorted(glob.glob(f"{preprocess_output}/chips/*.tif"))[:chips]:
+        name = os.path.basename(chip_path)[: -len(".tif")]
+        shutil.copy(chip_path, f"{output}/chips/{name}.tif")
+        with rio.open(chip_path) as src:
+            transform, crs, (height, width) = src.transform, src.crs, src.shape
+        buildings = []
+        for row in range(height // 13):
+            for col in range(width // 13):
+                x, y = col * 12.8 + rng.uniform(0, 2), row * 12.8 + rng.uniform(0, 2)
+                building_width, building_height = rng.uniform(9, 13, 2)
+                building = affinity.rotate(box(x, y, x + building_width, y + building_height), rng.uniform(-20, 20))
+                buildings.append(affinity.affine_transform(building, transform.to_shapely()))
+        gpd.GeoDataFrame(geometry=buildings, crs=crs).to_file(f"{output}/labels/{name}.geojson")
+
+
+def check_multimask_parity(preprocess_output: str) -> None:
+    """Check that the native multimasks equal the solaris df_to_px_mask output they replace."""
+    from ramp.utils.multimask_utils import df_to_px_mask, multimask_to_sparse_multimask
+
+    multimask_dir = f"{preprocess_output}/multimasks_parity"
+    shutil.rmtree(multimask_dir, ignore_errors=True)
+    multimasks_from_polygons(f"{preprocess_output}/labels", f"{preprocess_output}/chips", multimask_dir)
+
+    # confusion[expected, actual] counts the pixels of each pair of classes
+    confusion = np.zeros((4, 4), dtype=np.int64)
+    for chip_path in sorted(glob.glob(f"{preprocess_output}/chips/*.tif")):
+        name = os.path.basename(chip_path)[: -len(".tif")]
+        gdf = gpd.read_file(f"{preprocess_output}/labels/{name}.geojson")
+        gdf = gdf[~gdf["geometry"].isna() & ~gdf.is_empty]
+        with rio.open(chip_path) as src:
+            shape, resolution = src.shape, min(src.res)
+            metric = src.crs.linear_units in ("metre", "meter")
+            gdf = gdf.to_crs(src.crs)
+        # solaris takes the widths in CRS units for metric CRSs, and in pixels otherwise
+        scale = resolution if metric else 1
+        onehot = df_to_px_mask(
+            df=gdf.explode(ignore_index=True),
+            shape=shape,
+            do_transform=True,
+            channels=["footprint", "boundary", "contact"],
+            reference_im=chip_path,
+            boundary_width=scale * 3,
+            contact_spacing=scale * 8,
+            out_type="uint8",
+            meters=metric,
+        )
+        expected = multimask_to_sparse_multimask(onehot)[:, :, 0]
+        with rio.open(f"{multimask_dir}/{name}.mask.tif") as dataset:
+            actual = dataset.read(1)
+        np.add.at(confusion, (expected.ravel(), actual.ravel()), 1)
+
+    for value, name in enumerate(("footprint", "boundary", "contact"), start=1):
+        assert confusion[value, :].sum() > 0, f"The solaris masks of {preprocess_output} have no {name} pixels"
+    mismatches = confusion.sum() - np.trace(confusion)
+    assert mismatches == 0, f"{mismatches} multimask pixels differ from solaris in {preprocess_output}:\n{confusion}"
+    print(f"Multimasks in {preprocess_output} equal solaris on all {confusion.sum()} pixels")
+
+
+def check_incremental_rerun(input_path: str, output_path: str) -> None:
+    """Rerun an incremental parquet preprocess with nothing changed, which must regenerate nothing."""
+    shutil.rmtree(output_path, ignore_errors=True)
+    options = {
+        "rasterize": True,
+        "rasterize_options": ["binary"],
+        "georeference_images": True,
+        "multimasks": True,
+        "incremental": True,
+        "labels_format": "parquet",
+    }
+    preprocess(input_path=input_path, output_path=output_path, **options)
+    masks = {path: os.stat(path).st_mtime_ns for path in glob.glob(f"{output_path}/multimasks/*.mask.tif")}
+    assert masks, f"No multimasks were generated in {output_path}"
+
+    preprocess(input_path=input_path, output_path=output_path, **options)
+    rerun_masks = {path: os.stat(path).st_mtime_ns for path in glob.glob(f"{output_path}/multimasks/*.mask.tif")}
+    assert rerun_masks == masks, "A rerun with nothing changed regenerated multimasks"
+    print(f"Incremental rerun kept all {len(masks)} multimasks")
+
+
+def check_resumed_batches(train_output: str, skip_batches: int = 3, batch_size: int = 2) -> None:
+    """Check that a tf.data pipeline rebuilt to skip batches yields the batches of the uninterrupted stream."""
+    augment = get_batch_augmentation_fn(RAMP_CONFIG)
+
+    def batches(skip):
+        return training_batches(
+            f"{train_output}/chips",
+            f"{train_output}/binarymasks",
+            batch_size,
+            RAMP_CONFIG["input_img_shape"],
+            RAMP_CONFIG["output_img_shape"],
+            batch_transforms=augment,
+            skip_batches=skip,
+        )
+
+    expected = batches(0).skip(skip_batches).take(4).as_numpy_iterator()
+    resumed = batches(skip_batches).take(4).as_numpy_iterator()
+    for (expected_images, expected_masks), (images, masks) in zip(expected, resumed, strict=True):
+        assert np.array_equal(images, expected_images), "A resumed pipeline yields other images"
+        assert np.array_equal(masks, expected_masks), "A resumed pipeline yields other masks"
+
+
+def check_resume(preprocess_output: str, train_output: str, epochs: int = 2, timeout: float = 1800) -> None:
+    """Kill a tf.data training once its first epoch is saved, resume it, and compare it with an uninterrupted one."""
+    train_kwargs = {
+        "input_path": preprocess_output,
+        "output_path": train_output,
+        "epoch_size": epochs,
+        "batch_size": 2,
+        "model": "ramp",
+        "model_home": os.environ["RAMP_HOME"],
+        "tf_data": True,
+        "batched_augmentation": True,
+        "resumable": True,
+    }
+
+    uninterrupted_output = f"{train_output}_uninterrupted"
+    shutil.rmtree(uninterrupted_output, ignore_errors=True)
+    train(**{**train_kwargs, "output_path": uninterrupted_output})
+    expected = load_training_state(f"{uninterrupted_output}/training-state")
+
+    state_dir = f"{train_output}/training-state"
+    process = multiprocessing.get_context("spawn").Process(target=train, kwargs=train_kwargs)
+    process.start()
+    deadline = time.monotonic() + timeout
+    while load_training_state(state_dir) is None and process.is_alive() and time.monotonic() < deadline:
+        time.sleep(0.5)
+    process.kill()
+    process.join()
+
+    state = load_training_state(state_dir)
+    assert state is not None, "No training state was saved before the training was killed"
+    print(f"Training killed after epoch {state['epoch']}, resuming")
+
+    final_accuracy, final_model_path = train(**train_kwargs, resume=True)
+    state = load_training_state(state_dir)
+    assert state is not None and state["epoch"] == epochs, f"Resumed training stopped at {state and state['epoch']}"
+    assert os.path.isfile(final_model_path), f"Resumed training exported no model: {final_model_path}"
+    print(f"Resumed training: {final_accuracy} {final_model_path}")
+
+    check_resumed_batches(train_output)
+    # The batches are the same, only the dropout draws of the resumed epochs differ
+    expected_loss = [logs["loss"] for logs in expected["history"]]
+    resumed_loss = [logs["loss"] for logs in state["history"]]
+    print(f"Loss history: uninterrupted {expected_loss}, resumed {resumed_loss}")
+    assert np.allclose(resumed_loss, expected_loss, rtol=0.05), "The resumed training diverged"
+
+
+def check_packed_training(base_path: str, train_output: str, chips: int = 16) -> None:
+    """Train one short epoch on a packed store through tf.data, with a file cache and batched augmentation."""
+    input_path = f"{train_output}_input"
+    preprocess_output = f"{train_output}_preprocessed"
+    for path in (input_path, preprocess_output, train_output):
+        shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(input_path)
+    shutil.copy(f"{base_path}/input/labels.geojson", input_path)
+    for image_path in sorted(glob.glob(f"{base_path}/input/*.png"))[:chips]:
+        shutil.copy(image_path, input_path)
+
+    preprocess(
+        input_path=input_path,
+        output_path=preprocess_output,
+        rasterize=True,
+        rasterize_options=["binary"],
+        georeference_images=True,
+        pack=True,
+    )
+    final_accuracy, final_model_path = train(
+        input_path=preprocess_output,
+        output_path=train_output,
+        epoch_size=1,
+        batch_size=2,
+        model="ramp",
+        model_home=os.environ["RAMP_HOME"],
+        tf_data=True,
+        cache="file",
+        batched_augmentation=True,
+    )
+    assert os.path.isfile(final_model_path), f"The packed training exported no model: {final_model_path}"
+    assert glob.glob(f"{train_output}/tf-cache/train*"), "The packed training wrote no cache file"
+    print(f"Packed tf.data training: {final_accuracy} {final_model_path}")
+
+
 def main() -> None:
     start_time = time.perf_counter()
     workspace = os.getcwd()
@@ -38,6 +243,23 @@ def main() -> None:
         georeference_images=True,
         multimasks=False,
     )
+    check_multimask_parity(preprocess_output)
+
+    # solaris buffers in CRS units in EPSG:3857 and in pixels in EPSG:4326
+    preprocess_output_4326 = f"{base_path}/preprocessed_4326"
+    shutil.rmtree(preprocess_output_4326, ignore_errors=True)
+    preprocess(
+        input_path=f"{base_path}/input",
+        output_path=preprocess_output_4326,
+        georeference_images=True,
+        epsg=4326,
+    )
+    check_multimask_parity(preprocess_output_4326)
+    for dense_input in (preprocess_output, preprocess_output_4326):
+        dense_output = f"{dense_input}_dense"
+        make_dense_fixture(dense_input, dense_output)
+        check_multimask_parity(dense_output)
+    check_incremental_rerun(f"{base_path}/input", f"{base_path}/preprocessed_incremental")
 
     final_accuracy, final_model_path = train(
         input_path=preprocess_output,
@@ -49,6 +271,13 @@ def main() -> None:
     )
     print(final_accuracy, final_model_path)
 
+    check_packed_training(base_path, f"{base_path}/train_ramp_packed")
+
+    resume_output = f"{base_path}/train_ramp_resume"
+    if os.path.isdir(resume_output):
+        shutil.rmtree(resume_output)
+    check_resume(preprocess_output, resume_output)
+
     prediction_output = f"{base_path}/prediction/ramp_output"
     if os.path.isdir(prediction_output):
         shutil.rmtree(prediction_output)
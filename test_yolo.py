@@ -1,16 +1,177 @@
 # Standard library imports
+import filecmp
+import glob
+import hashlib
 import os
 import shutil
 import time
 import warnings
 
+# Third party imports
+from PIL import Image
+
 # Reader imports
 from hot_fair_utilities import polygonize, predict, preprocess
-from hot_fair_utilities.preprocessing.yolo_v8.yolo_format import yolo_format
+from hot_fair_utilities.preprocessing.yolo_v8.utils import LabelWriter
+from hot_fair_utilities.preprocessing.yolo_v8.yolo_format import assign_splits, yolo_format
 from hot_fair_utilities.training.yolo_v8.train import train as train_yolo
 
 warnings.simplefilter(action="ignore", category=FutureWarning)
 
+# Digest of the YOLO labels of the sample preprocessed in EPSG:4326, as written
+# by the conversion before it was made parallel and incremental
+BASELINE_LABEL_DIGEST = "6e46fd588f83802552719896c2d676a4d29ac7bfb4783470747cba39a4d76185"
+
+
+def label_files(yolo_dir: str) -> dict[str, str]:
+    """Return the path of each label file of a YOLO dataset, by file name."""
+    return {os.path.basename(path): path for path in glob.glob(f"{yolo_dir}/labels/*/*.txt")}
+
+
+def label_digest(yolo_dir: str) -> str:
+    """Digest the names and contents of the label files of a YOLO dataset, whatever their split."""
+    digest = hashlib.sha256()
+    for name, path in sorted(label_files(yolo_dir).items()):
+        with open(path, "rb") as file:
+            digest.update(name.encode() + b"\0" + file.read() + b"\0")
+    return digest.hexdigest()
+
+
+def label_splits(yolo_dir: str) -> dict[str, str]:
+    """Return the split of each label file of a YOLO dataset, by file name."""
+    return {name: os.path.basename(os.path.dirname(path)) for name, path in label_files(yolo_dir).items()}
+
+
+def file_stamps(yolo_dir: str) -> dict[str, tuple[int, int]]:
+    """Return the modification and change times of the images and labels, which any rewrite or relink changes."""
+    paths = glob.glob(f"{yolo_dir}/images/*/*") + glob.glob(f"{yolo_dir}/labels/*/*")
+    return {path: (os.lstat(path).st_mtime_ns, os.lstat(path).st_ctime_ns) for path in paths}
+
+
+def check_labels(yolo_dir: str) -> None:
+    """Check the labels of a YOLO dataset of the sample against the baseline."""
+    digest = label_digest(yolo_dir)
+    assert digest == BASELINE_LABEL_DIGEST, f"The labels of {yolo_dir} differ from the baseline: {digest}"
+    print(f"Labels of {yolo_dir} equal the baseline")
+
+
+def check_rerun(preprocess_output: str, yolo_dir: str) -> None:
+    """Rerun a conversion with nothing changed, which must rewrite no image or label."""
+    stamps = file_stamps(yolo_dir)
+    yolo_format(input_path=preprocess_output, output_path=yolo_dir)
+    assert file_stamps(yolo_dir) == stamps, "A rerun with nothing changed rewrote images or labels"
+    print(f"Rerun kept all {len(stamps)} images and labels")
+
+
+def check_split_stability(preprocess_output: str, workdir: str) -> None:
+    """Add one chip to a converted dataset, which must keep the split and files of the other chips."""
+    input_path, yolo_dir = f"{workdir}/input", f"{workdir}/yolo"
+    shutil.rmtree(workdir, ignore_errors=True)
+    for folder in ("chips", "labels"):
+        shutil.copytree(f"{preprocess_output}/{folder}", f"{input_path}/{folder}")
+
+    added = os.path.basename(sorted(glob.glob(f"{input_path}/chips/*.tif"))[0])[: -len(".tif")]
+    os.rename(f"{input_path}/chips/{added}.tif", f"{workdir}/{added}.tif")
+    os.rename(f"{input_path}/labels/{added}.geojson", f"{workdir}/{added}.geojson")
+    yolo_format(input_path=input_path, output_path=yolo_dir)
+    splits, stamps = label_splits(yolo_dir), file_stamps(yolo_dir)
+
+    os.rename(f"{workdir}/{added}.tif", f"{input_path}/chips/{added}.tif")
+    os.rename(f"{workdir}/{added}.geojson", f"{input_path}/labels/{added}.geojson")
+    yolo_format(input_path=input_path, output_path=yolo_dir)
+    rerun_splits, rerun_stamps = label_splits(yolo_dir), file_stamps(yolo_dir)
+
+    assert set(rerun_splits) - set(splits) == {f"{added}.txt"}, "Adding a chip did not add exactly its label"
+    assert {name: rerun_splits[name] for name in splits} == splits, "Adding a chip moved other chips to another split"
+    assert {path: rerun_stamps[path] for path in stamps} == stamps, "Adding a chip rewrote the files of other chips"
+    print(f"Adding {added} kept the split and files of the other {len(splits)} chips")
+
+
+def check_assign_splits() -> None:
+    """Check that assign_splits leaves no non-zero split empty, and rejects too few tiles."""
+    tile_ids = [f"OAM-{x}-0-19" for x in range(3)]
+    assert sorted(assign_splits(tile_ids)) == ["test", "train", "val"], "Three tiles must fill the three splits"
+    assert sorted(assign_splits(tile_ids[:2], train_split=0.5, val_split=0.5, test_split=0)) == ["train", "val"]
+    try:
+        assign_splits(tile_ids[:2])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("assign_splits filled three splits with two tiles")
+
+
+def check_label_writer(workdir: str) -> None:
+    """Check that LabelWriter writes every queued file and reports the errors of its thread."""
+    shutil.rmtree(workdir, ignore_errors=True)
+    contents = {f"{workdir}/{folder}/{index}.txt": f"{index}\n" for folder in ("a", "b") for index in range(100)}
+    with LabelWriter(max_pending=8) as writer:
+        for path, content in contents.items():
+            writer.write(path, content)
+    for path, content in contents.items():
+        with open(path) as file:
+            assert file.read() == content, f"LabelWriter wrote the wrong content to {path}"
+
+    # A label under a file cannot be written
+    blocked = f"{workdir}/a/0.txt/label.txt"
+    try:
+        with LabelWriter() as writer:
+            writer.write(blocked, "")
+    except OSError:
+        pass
+    else:
+        raise AssertionError("LabelWriter did not raise the error of a failed write")
+
+    # An error of the with block takes precedence over that of a write
+    try:
+        with LabelWriter() as writer:
+            writer.write(blocked, "")
+            raise KeyError("with block")
+    except KeyError:
+        pass
+    print("LabelWriter wrote all labels and raised the write errors")
+
+
+def check_workers(preprocess_output: str, yolo_dir: str, workers: int = 2) -> None:
+    """Convert with several workers, which must give the labels and splits of a single process."""
+    workers_dir = f"{yolo_dir}_workers"
+    shutil.rmtree(workers_dir, ignore_errors=True)
+    yolo_format(input_path=preprocess_output, output_path=workers_dir, workers=workers)
+    check_labels(workers_dir)
+    assert label_splits(workers_dir) == label_splits(yolo_dir), f"{workers} workers assigned other splits"
+
+
+def check_direct_labels(preprocess_output: str, labels_path: str, yolo_dir: str) -> None:
+    """Convert from the global labels instead of the per-tile label files, which must give the same labels."""
+    direct_dir = f"{yolo_dir}_direct"
+    shutil.rmtree(direct_dir, ignore_errors=True)
+    yolo_format(input_path=preprocess_output, output_path=direct_dir, labels=labels_path)
+    check_labels(direct_dir)
+    assert label_splits(direct_dir) == label_splits(yolo_dir), "The global labels assigned other splits"
+
+
+def check_image_modes(preprocess_output: str, yolo_dir: str) -> None:
+    """Convert with each image mode in turn into one dataset, which must be rebuilt for each."""
+    chips = {os.path.basename(path)[: -len(".tif")]: path for path in glob.glob(f"{preprocess_output}/chips/*.tif")}
+    modes_dir = f"{yolo_dir}_modes"
+    shutil.rmtree(modes_dir, ignore_errors=True)
+    for image_mode in ("link", "copy", "encode"):
+        yolo_format(input_path=preprocess_output, output_path=modes_dir, image_mode=image_mode)
+        check_labels(modes_dir)
+        images = glob.glob(f"{modes_dir}/images/*/*")
+        assert len(images) == len(chips), f"{len(images)} images for {len(chips)} chips with image_mode={image_mode}"
+        for image in images:
+            name, extension = os.path.splitext(os.path.basename(image))
+            if image_mode == "link":
+                assert os.path.samefile(image, chips[name]), f"{image} is not a link to its chip"
+            elif image_mode == "copy":
+                assert not os.path.samefile(image, chips[name]), f"{image} is a link to its chip"
+                assert filecmp.cmp(image, chips[name], shallow=False), f"{image} differs from its chip"
+            else:
+                assert extension == ".jpg", f"{image} is not a JPEG"
+                with Image.open(image) as encoded, Image.open(chips[name]) as chip:
+                    assert encoded.format == "JPEG" and encoded.size == chip.size, f"{image} is not its chip in JPEG"
+    print("Images were linked, copied and encoded")
+
 
 def main() -> None:
     start_time = time.perf_counter()
@@ -44,6 +205,15 @@ def main() -> None:
     )
     print(f"yolo conversion took {round(time.perf_counter() - conversion_start, 2)} seconds")
 
+    check_labels(yolo_data_dir)
+    check_rerun(preprocess_output, yolo_data_dir)
+    check_split_stability(preprocess_output, f"{base_path}/yolo_split_stability")
+    check_assign_splits()
+    check_label_writer(f"{base_path}/yolo_label_writer")
+    check_workers(preprocess_output, yolo_data_dir)
+    check_direct_labels(preprocess_output, f"{base_path}/input/labels.geojson", yolo_data_dir)
+    check_image_modes(preprocess_output, yolo_data_dir)
+
     output_model_path, output_model_iou_accuracy = train_yolo(
         data=base_path,
         weights=f"{workspace}/yolov8s_v2-seg.pt",